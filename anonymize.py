@@ -1,4 +1,4 @@
-import sys
+import argparse
 import json
 from anonymize_it.anonymizers import Anonymizer
 from anonymize_it.readers import reader_mapping
@@ -17,9 +17,14 @@ def read_config(config_file):
 if __name__ == "__main__":
     logging.basicConfig(format='%(asctime)s %(message)s', datefmt='%m/%d/%Y %I:%M:%S %p ->', level=logging.INFO)
 
+    parser = argparse.ArgumentParser(description="anonymize data as configured by a config file")
+    parser.add_argument("config_file")
+    parser.add_argument("--resume", action="store_true",
+                        help="continue the last run from its checkpoint if it failed, see the checkpoint setting")
+    args = parser.parse_args()
+
     logging.info("reading and parsing config file...")
-    config_file = sys.argv[1]
-    config = read_config(config_file)
+    config = read_config(args.config_file)
     config = utils.parse_config(config)
 
     for conf in config._fields:
@@ -37,4 +42,6 @@ if __name__ == "__main__":
     anon = Anonymizer(reader=reader, writer=writer)
 
     logging.info("performing anonymization...")
-    anon.anonymize(sensitive_fields=config.sensitive, infer=True, include_rest=config.include_rest, anonymization_type = config.anonymization_type)
+    anon.anonymize(sensitive_fields=config.sensitive, infer=True, include_rest=config.include_rest, anonymization_type = config.anonymization_type, workers=config.workers, mapping_params=config.mappings, pipeline_params=config.pipeline,
+                   checkpoint_params=config.checkpoint, resume=args.resume,
+                   metrics_params=config.metrics)
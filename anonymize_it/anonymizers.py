@@ -3,10 +3,19 @@ import warnings
 from . import readers
 from . import writers
 from . import utils
-import re
-import json
+from . import transforms
+from . import patterns
+from . import mappings
+from . import pipeline
+from . import checkpoints
+from . import metrics
+from . import serializers
+import collections
+import contextlib
+import itertools
 import logging
-import os
+import multiprocessing
+import numpy
 class AnonymizerError(Exception):
     pass
 
@@ -49,13 +58,30 @@ class Anonymizer:
         # drop documents if they contain these keywords
         self.keywords = []
 
-        self.dir_path = os.path.abspath(os.path.dirname(__file__))
-        with open(os.path.join(self.dir_path, "secret_regexes.json"), "r") as f:
-            self.secret_regexes = json.load(f)
+        # keyword matching options, like {"ignorecase": True, "whole_word": True}
+        self.keyword_options = {}
+
+        # hash engine options, like {"cache_size": 100000}, see utils.Hasher
+        self.hash_options = {}
+
+        # if true, json output has the nested objects of the source documents instead of flattened field names
+        self.nested_output = False
+
+        # the json serializer of output documents: json, orjson, or auto for orjson when it is installed, see
+        # serializers.py
+        self.serializer = 'json'
+
+        self.secret_regexes = patterns.load_secret_regexes()
 
         self.field_maps = field_maps
         self.reader = reader
         self.writer = writer
+        self.hashkey = None
+        self.pipeline = None
+
+        # counters and latency histograms of the last run, see metrics.py
+        self.metrics = metrics.Metrics()
+        self.metrics_params = {}
 
         self.source = None
         self.dest = None
@@ -80,7 +106,7 @@ class Anonymizer:
         if not source_params:
             raise ReaderError("source params not defined: please check config")
 
-        reader = readers.mapping.get(self.reader_type)
+        reader = readers.reader_mapping.get(self.reader_type)
         if not reader:
             raise ReaderError("No reader named {} defined.".format(self.reader_type))
 
@@ -91,18 +117,44 @@ class Anonymizer:
         if not dest_params:
             raise WriterError("dest params not define: please check config")
 
-        writer = writers.mapping.get(self.writer_type)
+        writer = writers.writer_mapping.get(self.writer_type)
         if not writer:
             raise WriterError("No writer named {} defined.".format(self.writer_type))
 
         self.writer = writer(dest_params)
 
-    def anonymize(self, sensitive_fields=[], infer=False, include_rest=False, anonymization_type="faker"):
+    def anonymize(self, sensitive_fields=[], infer=False, include_rest=False, anonymization_type="faker", workers=1,
+                  mapping_params=None, pipeline_params=None, checkpoint_params=None, resume=False, metrics_params=None):
         """this is the core method for anonymizing data
 
         it utilizes specific reader and writer class methods to retrieve and store data. in the process
         we define mappings of unmasked values to masked values, and anonymize fields using self.faker
+
+        :param workers: number of worker processes. if greater than 1, the reader's data is split into slices that
+            are anonymized and written in parallel. output documents are the same as in a serial run.
+        :param mapping_params: a dict of settings for faker field maps, see create_field_maps
+        :param pipeline_params: if set, reading, anonymizing and writing overlap in a staged pipeline, see anonymize_data
+        :param checkpoint_params: if set, progress is saved to a checkpoint directory, configured by a dict like
+            {"directory": "checkpoint", "every": 10, "since": "@timestamp"}, see checkpoints.Checkpoint
+        :param resume: if true, continue the checkpoint's last run if it failed, instead of starting over
+        :param metrics_params: a dict like {"json": "metrics.json", "prometheus": "metrics.prom", "transforms": true,
+            "profile": "run.prof", "profiler": "cprofile"}. json and prometheus are the files self.metrics is written
+            to at the end of the run. transforms times the transforms of each field. profile is the file the hot loop
+            is profiled to, by cprofile or a sampling profiler, see metrics.profile. parallel workers add the slice to
+            the file name, like run.prof.s000
         """
+        self.metrics_params = metrics_params or {}
+        self.metrics = metrics.Metrics(self.metrics.callback)
+        self.reader.metrics = self.writer.metrics = self.metrics
+
+        checkpoint = None
+        restore_maps = False
+        if checkpoint_params:
+            checkpoint = self.start_checkpoint(checkpoint_params, workers, resume)
+            restore_maps = checkpoint.run['mappings']
+            mapping_params = dict(mapping_params or {})
+            # fake values are kept with the checkpoint, so a resumed or later run uses the same fake values
+            mapping_params.setdefault('store', checkpoint.store_path)
 
         # If anonymization type is faker
         if anonymization_type == "faker":
@@ -111,20 +163,12 @@ class Anonymizer:
                 self.reader.infer_providers()
 
             # next, create masking maps that will be used for lookups when anonymizing data
-            self.field_maps = self.reader.create_mappings()
-
-            for field, map in self.field_maps.items():
-                for value, _ in map.items():
-                    mask_str = self.reader.masked_fields[field]
-                    if mask_str != 'infer':
-                        if mask_str not in self.high_cardinality_fields:
-                            mask = self.provider_map[mask_str]
-                            map[value] = mask()
+            self.field_maps = self.create_field_maps(mapping_params or {}, workers, restore=restore_maps)
+            if checkpoint:
+                checkpoint.mappings_done()
 
         elif anonymization_type == "hash":
-            self.hashkey = utils.get_hashkey(es=self.reader.es)
-            if not self.hashkey:
-                raise AnonymizerError("Could not find valid hashkey")
+            self.resolve_hashkey()
         else:
             raise AnonymizerError("Invalid anonymization type. Choose faker/hash")
 
@@ -132,66 +176,496 @@ class Anonymizer:
         total = self.reader.get_count()
         logging.info("total number of records {}...".format(total))
 
-        data = self.reader.get_data(include_rest)
+        # compiled once per set of settings, and shared with parallel workers
+        self.patterns = patterns.get_registry(self.secret_regexes, self.user_regexes, self.keywords, self.keyword_options)
+
+        self.writer.open()
+        try:
+            if workers > 1:
+                self.anonymize_parallel(workers, sensitive_fields, include_rest, anonymization_type, pipeline_params,
+                                        checkpoint)
+            else:
+                self.anonymize_slice(self.writer, sensitive_fields, include_rest, anonymization_type, total,
+                                     pipeline_params, checkpoint=checkpoint)
+        finally:
+            self.writer.close()
+            self.metrics.log()
+            self.metrics.dump(self.metrics_params.get('json'), self.metrics_params.get('prometheus'))
+        if checkpoint:
+            checkpoint.complete()
+
+    def start_checkpoint(self, checkpoint_params, workers, resume=False):
+        """start or resume a checkpointed run, and limit the reader to the run's window if the checkpoint has a since field
+
+        :return: a checkpoints.Checkpoint
+        """
+        if getattr(self.reader, 'pagination', None) == 'scroll':
+            raise AnonymizerError("checkpoints require pit pagination, scrolls can't be resumed")
+        if getattr(self.reader, 'slices', 1) > 1:
+            raise AnonymizerError("checkpoints can't resume merged reader slices, use workers instead")
+
+        checkpoint = checkpoints.Checkpoint(checkpoint_params['directory'], checkpoint_params.get('every', 10),
+                                            checkpoint_params.get('since'))
+        try:
+            checkpoint.start(workers, resume)
+        except checkpoints.CheckpointError as e:
+            raise AnonymizerError(str(e))
+
+        if checkpoint.since:
+            if not hasattr(self.reader, 'add_range'):
+                raise AnonymizerError("{} can't read documents since the last run".format(type(self.reader).__name__))
+            since, until = checkpoint.window
+            logging.info("reading documents with {} after {} up to {}...".format(checkpoint.since, since, until))
+            self.reader.add_range(checkpoint.since, gt=since, lte=until)
+        return checkpoint
+
+    def resolve_hashkey(self):
+        """set self.hashkey, unless it is already set, see utils.get_hashkey
+
+        this runs in the main process only. parallel workers are sent the anonymizer with the hashkey already set.
+        """
+        self.hashkey = self.hashkey or utils.get_hashkey(es=self.reader.es)
+        if not self.hashkey:
+            raise AnonymizerError("Could not find valid hashkey")
+        return self.hashkey
+
+    def create_field_maps(self, mapping_params, workers=1, restore=False):
+        """create the maps of original to fake values used with anonymization_type="faker"
+
+        :param mapping_params: a dict like {"mode": "lazy", "max_size": 1000000}. modes are:
+            eager (default): the reader enumerates all distinct values of the masked fields, and fake values for all of
+                them are generated before any document is read
+            lazy: fake values are generated the first time a value is seen while anonymizing. if max_size is set, each
+                field map remembers at most max_size values
+            if store is set to the path of an sqlite file, fake values are kept in that file (see mappings.MappingStore)
+            and reused by later runs, so pseudonyms stay the same across runs that share the file. in lazy mode, a store
+            also allows multiple workers to share field maps.
+            deterministic: the faker provider is seeded from a keyed hash of each value (see
+                mappings.DeterministicFieldMap), so no values are stored, workers need no shared state, and values are
+                the same in every run with the same hashkey. cache_size sets the number of recent values cached per field
+            in eager mode, if compact is set, complete maps are stored as mappings.CompactFieldMap, which takes a
+            fraction of the memory of a dict. once the maps take more than max_memory bytes, further maps are spilled
+            to memory-mapped files in spill_dir (default: the temporary directory). cache_size sets the number of
+            recent values cached per field
+        :param workers: the number of worker processes the maps will be used by
+        :param restore: if true, eager maps are loaded from the store, which already holds all the values of this run
+        """
+        mode = mapping_params.get('mode', 'eager')
+        if mode not in ('eager', 'lazy', 'deterministic'):
+            raise AnonymizerError("Invalid mapping mode {}. Choose eager/lazy/deterministic".format(mode))
+
+        if mode == 'deterministic':
+            self.resolve_hashkey()
+            field_maps = {}
+            for field, mask_str in self.reader.masked_fields.items():
+                if mask_str and mask_str != 'infer' and mask_str not in self.high_cardinality_fields:
+                    field_maps[field] = mappings.DeterministicFieldMap(
+                        self.faker, self.provider_map[mask_str], self.hashkey, mapping_params.get('cache_size', 4096))
+                else:
+                    field_maps[field] = {}
+            return field_maps
+
+        store = None
+        if mapping_params.get('store'):
+            store = mappings.MappingStore(mapping_params['store'])
+            logging.info("using mapping store {} with {} stored values...".format(store.path, store.count()))
+        elif mode == 'lazy' and workers > 1:
+            raise AnonymizerError("lazy field maps are filled per process, use a mapping store to share them between workers")
+
+        def field_map(field, mask):
+            if store:
+                return store.field_map(field, mask, mapping_params.get('max_size'))
+            return mappings.LazyFieldMap(mask, mapping_params.get('max_size'), name=field)
+
+        if mode == 'lazy':
+            field_maps = {}
+            for field, mask_str in self.reader.masked_fields.items():
+                if mask_str and mask_str != 'infer' and mask_str not in self.high_cardinality_fields:
+                    field_maps[field] = field_map(field, self.provider_map[mask_str])
+                else:
+                    field_maps[field] = {}
+            return field_maps
+
+        if restore and store:
+            logging.info("restoring field maps from {}...".format(store.path))
+            field_maps = {}
+            for field, mask_str in self.reader.masked_fields.items():
+                if mask_str and mask_str != 'infer' and mask_str not in self.high_cardinality_fields:
+                    field_maps[field] = store.load(field)
+                else:
+                    field_maps[field] = {}
+            return self.compact_field_maps(field_maps, mapping_params)
+
+        field_maps = self.reader.create_mappings()
+        for field, map in field_maps.items():
+            mask_str = self.reader.masked_fields[field]
+            if map and mask_str != 'infer':
+                if mask_str not in self.high_cardinality_fields:
+                    mask = self.provider_map[mask_str]
+                    if store:
+                        stored = store.fill(field, map, mask)
+                        # the few values the store can't hold are looked up one at a time, and since the map is
+                        # already in memory, the store's own cache only needs to hold one value
+                        fakes = store.field_map(field, mask, max_size=1)
+                        for value in map:
+                            map[value] = stored[value] if value in stored else fakes.get(value)
+                    else:
+                        for value in map:
+                            map[value] = mask()
+        return self.compact_field_maps(field_maps, mapping_params)
+
+    def compact_field_maps(self, field_maps, mapping_params):
+        """replace complete dict field maps with mappings.CompactFieldMap if mapping_params has compact set
+
+        each dict is replaced as soon as its compact map is built, so only one field's dict is freed at a time.
+        """
+        if not mapping_params.get('compact'):
+            return field_maps
+        max_memory = mapping_params.get('max_memory')
+        in_memory = 0
+        for field in list(field_maps):
+            mask_str = self.reader.masked_fields.get(field)
+            if not field_maps[field] or mask_str == 'infer' or mask_str in self.high_cardinality_fields:
+                continue
+            compact = mappings.CompactFieldMap(field_maps[field].items(), name=field,
+                                               cache_size=mapping_params.get('cache_size', 65536))
+            field_maps[field] = compact
+            if max_memory is not None and in_memory + compact.nbytes > max_memory:
+                compact.spill(mapping_params.get('spill_dir'))
+            else:
+                in_memory += compact.nbytes
+            logging.info("field map for {} holds {} values in {} bytes...".format(field, len(compact), compact.nbytes))
+        return field_maps
+
+    def anonymize_parallel(self, workers, sensitive_fields, include_rest, anonymization_type, pipeline_params=None,
+                           checkpoint=None):
+        """anonymize data using a pool of worker processes
+
+        the reader's data is split into one slice per worker. the anonymizer, including the field maps and compiled
+        regexes, is sent to each worker once when the pool starts, and each worker opens its own connections, see
+        reconnect. every worker reads its own slice and writes its own output through the configured writer.
+        """
+        logging.info("starting {} anonymization workers...".format(workers))
+        jobs = [(slice_id, workers, sensitive_fields, include_rest, anonymization_type, pipeline_params, checkpoint)
+                for slice_id in range(workers)]
+        with multiprocessing.Pool(workers, initializer=_init_worker, initargs=(self,)) as pool:
+            results = pool.starmap(_anonymize_slice, jobs)
+        counts = []
+        for count, worker_metrics in results:
+            counts.append(count)
+            self.metrics.merge(worker_metrics)
+        logging.info("{} records written by {} workers...".format(sum(counts), workers))
+        return sum(counts)
+
+    def reconnect(self):
+        """open new connections for the reader, writer and mapping stores in a parallel worker
+
+        workers are forked on linux, so they start with copies of the clients of the main process, and the sockets
+        those have open. pickling isn't involved, so the workers have to replace them explicitly.
+        """
+        self.reader.reconnect()
+        self.writer.reconnect()
+        stores = {id(field_map.store): field_map.store for field_map in self.field_maps.values()
+                  if isinstance(field_map, mappings.PersistentFieldMap)}
+        for store in stores.values():
+            store.reconnect()
+
+    def compile_plan(self, sensitive_fields, anonymization_type):
+        """compile the anonymization settings into a plan of per-field transforms
+
+        this runs once per run, so that documents only need a single lookup per field in the plan
+        and fields without any work to do are skipped.
+
+        :return: a dict like {'field.name': transform}, see transforms.py
+        """
+        steps = {}
+
+        # First anonymize fields based on anonymization type
+        if anonymization_type == "faker":
+            for field, field_map in self.field_maps.items():
+                if field_map:
+                    steps[field] = [transforms.map_values(field_map)]
+            for field, choices in self.high_cardinality_fields.items():
+                if choices:
+                    steps[field] = [transforms.high_cardinality(choices)]
+        else:
+            # one hasher for all fields, since a value's hash doesn't depend on its field
+            hasher = utils.Hasher(self.hashkey, **self.hash_options)
+            for field in self.reader.masked_fields:
+                steps[field] = [transforms.hash_values(hasher)]
+
+        # Check sensitive fields for keywords and secrets
+        for field in sensitive_fields or []:
+            if field in self.field_maps or field in self.high_cardinality_fields:
+                raise AnonymizerError("Sensitive fields should not be anonymized using faker providers")
+            field_steps = steps.setdefault(field, [])
+            # Don't proceed if any field contains keywords
+            if self.patterns.keywords:
+                field_steps.append(transforms.drop_document_if_keywords(self.patterns.keywords))
+            # Remove the field if it contains a secret
+            field_steps.append(transforms.drop_field_if_secret(self.patterns.secrets))
+            # Remove user information from fields
+            if self.patterns.users:
+                field_steps.append(transforms.scrub(self.patterns.users))
+
+        plan = {field: transforms.chain(field_steps) for field, field_steps in steps.items()}
+        if self.metrics_params.get('transforms'):
+            plan = {field: metrics.timed(transform, self.metrics, field) for field, transform in plan.items()}
+        return plan
+
+    def anonymize_document(self, doc, plan):
+        """apply a compiled plan to a flattened document
+
+        :return: the anonymized document, or None if the document should be dropped
+        """
+        for field, transform in plan.items():
+            if field in doc:
+                value = transform(doc[field])
+                if value is transforms.DROP_DOCUMENT:
+                    self.metrics.count('documents_dropped')
+                    return None
+                if value is transforms.DROP_FIELD:
+                    self.metrics.count('fields_removed')
+                    del doc[field]
+                else:
+                    doc[field] = value
+        return doc
+
+    def anonymize_frame(self, frame, plan):
+        """apply a compiled plan to a dataframe a column at a time
+
+        each transform runs once per distinct value of a column, found with factorize, and its results are spread back
+        over the rows, so rows are anonymized like anonymize_document would without a python loop per row.
+
+        :return: the anonymized dataframe, without the rows of dropped documents
+        """
+        frame = frame.copy()
+        dropped = numpy.zeros(len(frame), dtype=bool)
+        for field, transform in plan.items():
+            if field not in frame.columns:
+                continue
+            column = frame[field]
+            try:
+                codes, uniques = column.factorize()
+            except TypeError:
+                # columns of unhashable values, like lists, are transformed value by value
+                codes, uniques = numpy.where(column.isna(), -1, numpy.arange(len(column))), column.to_numpy()
+            # nulls have code -1, which takes the extra None at the end
+            results = numpy.empty(len(uniques) + 1, dtype=object)
+            drop_codes = []
+            removed_codes = []
+            for i, value in enumerate(uniques):
+                if isinstance(value, numpy.ndarray):
+                    # list cells read from parquet files
+                    value = value.tolist()
+                result = transform(value)
+                if result is transforms.DROP_DOCUMENT:
+                    drop_codes.append(i)
+                    result = None
+                elif result is transforms.DROP_FIELD:
+                    removed_codes.append(i)
+                    result = None
+                results[i] = result
+            if drop_codes:
+                dropped |= numpy.isin(codes, drop_codes)
+            if removed_codes:
+                self.metrics.count('fields_removed', int(numpy.isin(codes, removed_codes).sum()))
+            frame[field] = results[codes]
+        if dropped.any():
+            self.metrics.count('documents_dropped', int(dropped.sum()))
+        return frame[~dropped]
+
+    def anonymize_slice(self, writer, sensitive_fields, include_rest, anonymization_type, total=None,
+                        pipeline_params=None, slice_id=None, max_slices=None, checkpoint=None):
+        """read, anonymize and write all of the reader's data, or one slice of it
+
+        with a checkpoint, a slice continues from its saved position: after the meta.sort of the last hit written, when
+        the reader paginates with a point in time, and otherwise by skipping the items read before. anything the writer
+        wrote after the saved position is discarded first, see BaseWriter.restore.
+
+        with metrics_params["profile"] set, this is the code that is profiled
+
+        :return: the number of documents written
+        """
+        position = checkpoint.position(slice_id) if checkpoint else {}
+        if position.get('done'):
+            logging.info("slice {} is already complete...".format(slice_id if slice_id is not None else "all"))
+            return position['written']
+
+        offset = position.get('offset', 0)
+        options = {}
+        if position.get('sort'):
+            options['search_after'] = position['sort']
+        if position:
+            logging.info("resuming after {} items read and {} records written...".format(offset, position['written']))
+            writer.restore(position['writer'])
+        elif checkpoint:
+            checkpoint.save(slice_id, {"offset": 0, "sort": None, "written": 0, "done": False,
+                                       "writer": writer.checkpoint()})
+
+        profiler = contextlib.nullcontext()
+        if self.metrics_params.get('profile'):
+            profile_path = self.metrics_params['profile']
+            if slice_id is not None:
+                profile_path = "{}.s{:03d}".format(profile_path, slice_id)
+            profiler = metrics.profile(profile_path, self.metrics_params.get('profiler', 'cprofile'))
+
+        with profiler:
+            frames = self.reader.vectorized
+            if frames:
+                data = self.reader.get_frames(include_rest, slice_id=slice_id, max_slices=max_slices)
+            else:
+                data = self.reader.get_data(include_rest, slice_id=slice_id, max_slices=max_slices, **options)
+            if offset and not options:
+                data = itertools.islice(data, offset, None)
+
+            count = self.anonymize_data(data, writer, sensitive_fields, anonymization_type, total, pipeline_params,
+                                        frames=frames, checkpoint=checkpoint, slice_id=slice_id, position=position)
+        writer.flush()
+        if checkpoint:
+            checkpoint.save(slice_id, {"offset": None, "sort": None, "written": count, "done": True,
+                                       "writer": writer.checkpoint()})
+        return count
+
+    def anonymize_data(self, data, writer, sensitive_fields, anonymization_type, total=None, pipeline_params=None,
+                       frames=False, checkpoint=None, slice_id=None, position=None):
+        """anonymize an iterable of documents and write them out in batches
+
+        :param data: an iterable of hits as returned by a reader's get_data, either Hit objects or hit dicts
+        :param writer: the writer used for output
+        :param total: the expected number of documents, used to report progress
+        :param pipeline_params: if set, reading, anonymizing and writing run concurrently as a pipeline.Pipeline,
+            configured by a dict like {"read_queue": 4, "write_queue": 4}
+        :param frames: if true, data is an iterable of dataframes as returned by a reader's get_frames, each of which
+            is anonymized and written as one batch with anonymize_frame
+        :param checkpoint: if set, the position after the last batch written is saved every checkpoint.every batches
+        :param position: the saved position data continues from, if a run is resumed
+        :return: the number of documents written, including those written before a resumed position
+        """
+
+        plan = self.compile_plan(sensitive_fields, anonymization_type)
+        position = position or {}
+        # writers like ParquetWriter take the documents as they are, without serializing them to json
+        if writer.accepts_dicts:
+            serialize = (lambda item: item)
+        else:
+            serializer = serializers.get_serializer(self.serializer)
+            serialize = serializer.dumps if writer.accepts_bytes and serializer.binary else serializer.dumps_text
+            if self.nested_output:
+                dumps = serialize
+                serialize = (lambda item: dumps(utils.unflatten_nest(item)))
 
-        all_secrets_regex = re.compile('|'.join([regex for regex in self.secret_regexes.values()]))
+        def transform(batch):
+            tmp = []
+            self.metrics.count('documents_read', len(batch))
+            for item in batch:
+                # readers with raw hits return the hits of the response, which are flattened without building objects
+                source = item.get('_source', {}) if type(item) is dict else item.to_dict()
+                # transforms replace values, so the anonymized document is still flat
+                item = self.anonymize_document(utils.flatten_nest(source), plan)
+                if item is not None:
+                    tmp.append(serialize(item))
+            return tmp
+
+        def transform_frames(batch):
+            tmp = []
+            for frame in batch:
+                self.metrics.count('documents_read', len(frame))
+                tmp.extend(serialize(item) for item in utils.frame_records(self.anonymize_frame(frame, plan)))
+            return tmp
+
+        # the number of items read and the last item of each batch, in the order batches are written
+        read = collections.deque()
+        offset = position.get('offset', 0)
+        written = position.get('written', 0)
+        batches = 0
+        # only positions from a point in time scan can be resumed with search_after
+        sortable = getattr(self.reader, 'pagination', None) == 'pit'
+
+        def track(transform):
+            def tracked(batch):
+                batch = list(batch)
+                read.append((len(batch), batch[-1] if batch else None))
+                return transform(batch)
+            return tracked
+
+        def write(records):
+            nonlocal offset, written, batches
+            writer.write_data(records)
+            length, last = read.popleft()
+            offset += length
+            written += len(records)
+            batches += 1
+            if batches % checkpoint.every == 0:
+                writer.flush()
+                sort = None
+                if sortable:
+                    sort = last.get('sort') if type(last) is dict else getattr(getattr(last, 'meta', None), 'sort', None)
+                checkpoint.save(slice_id, {"offset": offset, "sort": list(sort) if sort else None, "written": written,
+                                           "done": False, "writer": writer.checkpoint()})
+
+        def log_progress(count):
+            self.metrics.batch_done()
+            count += position.get('written', 0)
+            if total:
+                logging.info("{} % complete...".format(count/total * 100))
+            else:
+                logging.info("{} records written...".format(count))
+
+        batch_size = 10000
+        if frames:
+            # every dataframe is already a batch
+            batch_size = 1
+            transform = transform_frames
+            if pipeline_params is not None:
+                pipeline_params = dict(pipeline_params, batch_size=batch_size)
+
+        write_data = writer.write_data
+        if checkpoint:
+            transform = track(transform)
+            write_data = write
+
+        if pipeline_params is not None:
+            self.pipeline = pipeline.Pipeline(**pipeline_params)
+            count = self.pipeline.run(data, transform, write_data, on_written=log_progress, metrics=self.metrics)
+            self.metrics.count('documents_written', count)
+            return count + position.get('written', 0)
 
         # batch process the data and write out to json in chunks
         count = 0
-        for batchiter in utils.batch(data, 10000):
-            tmp = []
-            for item in batchiter:
-                bulk = {
-                    "index": {
-                        "_index": item.meta['index'],
-                        "_type": 'doc'
-                    }
-                }
-                #tmp.append(json.dumps(bulk))
-                item = utils.flatten_nest(item.to_dict())
-                contains_keywords = False
-                for field in list(item):
-                    #First anonymize fiedls based on anonymization type
-                    if anonymization_type == "faker":
-                        if self.high_cardinality_fields.get(field):
-                            item[field] = self.high_cardinality_fields[field][len(item[field]) % len(self.high_cardinality_fields[field])]
-                        elif self.field_maps.get(field, None):
-                            if type(item[field]) == list:
-                                # Since this is a list we need to sub out every item
-                                item[field] = [self.field_maps[field].get(f, "This should not happen (list)!!!") for f in item[field]]
-                            else:
-                                item[field] = self.field_maps[field].get(item[field], "This should not happen!!!")
-                    else:
-                            if field in self.reader.masked_fields:
-                                if type(item[field]) == list:
-                                # Since this is a list we need to sub out every item
-                                    item[field] = [utils.hash_value(self.hashkey, f) for f in item[field]]
-                                else:
-                                    item[field] = utils.hash_value(self.hashkey, item[field])
-                    # Check sensitive fields for keywords and secrets
-                    if field in sensitive_fields:
-                        if field in self.field_maps or field in self.high_cardinality_fields:
-                            raise AnonymizerError("Sensitive fields should not be anonymized using faker providers")
-                        # Don't proceed if any field contains keywords
-                        if utils.contains_keywords(item[field], self.keywords):
-                            contains_keywords = True
-                            break
-                        # Remove the field if it contains a secret
-                        if utils.contains_secret(all_secrets_regex, item[field]):
-                            del item[field]
-                            continue
-                        # Remove user information from fields
-                        if self.user_regexes:
-                            all_users_regex = re.compile('|'.join([regex for regex in self.user_regexes.values()]), flags=re.MULTILINE|re.IGNORECASE)
-                            if type(item[field]) == list:
-                                item[field] = [re.sub(all_users_regex, r"\1", f) for f in item[field]]
-                            else:
-                                item[field] = re.sub(all_users_regex, r"\1", item[field])
-                                
-                if not contains_keywords:
-                    tmp.append(json.dumps(utils.flatten_nest(item)))
-                    
-            self.writer.write_data(tmp)
+        for batchiter in utils.batch(data, batch_size):
+            with self.metrics.timer('read_seconds'):
+                batchiter = list(batchiter)
+            with self.metrics.timer('anonymize_seconds'):
+                tmp = transform(batchiter)
+            with self.metrics.timer('write_seconds'):
+                write_data(tmp)
+            self.metrics.count('documents_written', len(tmp))
             count += len(tmp)
             #count += len(tmp) / 2# There is a bulk row for every document
-            logging.info("{} % complete...".format(count/total * 100))
+            log_progress(count)
+        return count + position.get('written', 0)
+
+
+# state of a worker process in a parallel run, set once by the pool initializer
+_worker_anonymizer = None
+
+
+def _init_worker(anonymizer):
+    global _worker_anonymizer
+    anonymizer.reconnect()
+    _worker_anonymizer = anonymizer
+
+
+def _anonymize_slice(slice_id, max_slices, sensitive_fields, include_rest, anonymization_type, pipeline_params,
+                     checkpoint=None):
+    anon = _worker_anonymizer
+    # each slice returns its own metrics, which the main process adds up
+    anon.metrics = metrics.Metrics()
+    anon.reader.metrics = anon.writer.metrics = anon.metrics
+    writer = anon.writer.for_shard(slice_id)
+    count = anon.anonymize_slice(writer, sensitive_fields, include_rest, anonymization_type,
+                                 pipeline_params=pipeline_params, slice_id=slice_id, max_slices=max_slices,
+                                 checkpoint=checkpoint)
+    logging.info("slice {} of {} complete, {} records written...".format(slice_id + 1, max_slices, count))
+    return count, anon.metrics
@@ -0,0 +1,115 @@
+"""checkpoints of the progress of a run, so that a failed run can be resumed
+
+a checkpoint is a directory holding:
+    run.json: the window of the run, its status, and the end of the window of the last complete run
+    slice-all.json, or slice-000.json etc. for parallel workers: how far each slice got. positions are the meta.sort
+        of the last hit written, when the reader returns one, and otherwise the number of items read. each slice
+        also keeps its writer's checkpoint state, see BaseWriter.checkpoint
+    mappings.sqlite: the mapping store used for faker field maps, unless another store is configured
+"""
+import datetime
+import glob
+import json
+import logging
+import os
+
+
+class CheckpointError(Exception):
+    pass
+
+
+def _read(path):
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def _write(path, state):
+    # written to a temporary file first, so a crash never leaves a half written checkpoint
+    tmp_path = "{}.tmp".format(path)
+    with open(tmp_path, 'w') as f:
+        json.dump(state, f)
+    os.replace(tmp_path, path)
+
+
+class Checkpoint:
+    """
+    :param directory: the checkpoint directory. it is created if it doesn't exist
+    :param every: the number of batches written between checkpoints
+    :param since: a date field, like @timestamp. if set, each run only reads documents from after the end of the
+        last complete run's window, up to the time the run started
+    """
+
+    def __init__(self, directory, every=10, since=None):
+        self.directory = directory
+        self.every = every
+        self.since = since
+        self.run = {}
+        os.makedirs(directory, exist_ok=True)
+
+    @property
+    def store_path(self):
+        return os.path.join(self.directory, 'mappings.sqlite')
+
+    def _run_path(self):
+        return os.path.join(self.directory, 'run.json')
+
+    def _slice_path(self, slice_id):
+        name = 'slice-all.json' if slice_id is None else 'slice-{:03d}.json'.format(slice_id)
+        return os.path.join(self.directory, name)
+
+    def start(self, workers, resume=False):
+        """start a run, or resume the last one if it didn't complete
+
+        :return: true if the last run is resumed
+        """
+        previous = _read(self._run_path())
+        if resume and previous.get('status') == 'running':
+            if previous.get('workers') != workers:
+                raise CheckpointError("the run to resume used {} workers, not {}".format(previous.get('workers'), workers))
+            self.run = previous
+            logging.info("resuming run started at {}...".format(self.run['started']))
+            return True
+        if resume:
+            logging.info("no failed run to resume, starting a new run...")
+
+        for path in glob.glob(os.path.join(self.directory, 'slice-*.json')):
+            os.remove(path)
+        now = datetime.datetime.now(datetime.timezone.utc).isoformat(timespec='milliseconds')
+        self.run = {
+            "status": "running",
+            "started": now,
+            "workers": workers,
+            # the window of a since run starts where the last complete run's window ended
+            "since": previous.get('last_until'),
+            "until": now,
+            "last_until": previous.get('last_until'),
+            "mappings": False,
+        }
+        _write(self._run_path(), self.run)
+        return False
+
+    @property
+    def window(self):
+        """the (since, until) window of documents to read, if the checkpoint has a since field"""
+        return self.run.get('since'), self.run.get('until')
+
+    def mappings_done(self):
+        """record that the field maps are complete in the mapping store, so a resumed run needn't create them again"""
+        self.run['mappings'] = True
+        _write(self._run_path(), self.run)
+
+    def position(self, slice_id=None):
+        """the saved progress of a slice: a dict with offset, sort, written, done and writer"""
+        return _read(self._slice_path(slice_id))
+
+    def save(self, slice_id, position):
+        _write(self._slice_path(slice_id), position)
+
+    def complete(self):
+        self.run['status'] = 'complete'
+        self.run['last_until'] = self.run['until']
+        _write(self._run_path(), self.run)
+        logging.info("run complete, next since run starts at {}...".format(self.run['until']))
@@ -0,0 +1,430 @@
+"""field maps that are filled while documents are anonymized, or that store complete maps compactly
+
+field maps translate original values of a field to fake values, and are used through get(value, default) like the
+dicts returned by a reader's create_mappings.
+"""
+from array import array
+from bisect import bisect_left
+import collections
+import functools
+import hashlib
+import logging
+import mmap
+import os
+import socket
+import sqlite3
+import tempfile
+import weakref
+from . import utils
+
+
+class LazyFieldMap:
+    """a field map that generates a fake value the first time an original value is seen
+
+    values stay consistent for as long as they are remembered. if max_size is set, the least recently used values are
+    forgotten once the map holds max_size values, and a forgotten value that is seen again gets a new fake value.
+
+    :param provider: a callable returning a new fake value, e.g. a faker provider
+    :param max_size: the maximum number of values to remember, or None to remember all values
+    :param name: the name of the field, used for logging
+    """
+
+    def __init__(self, provider, max_size=None, name=None):
+        self.provider = provider
+        self.max_size = max_size
+        self.name = name
+        self.values = collections.OrderedDict() if max_size else {}
+        self.evicted = 0
+
+    def get(self, value, default=None):
+        try:
+            fake = self.values[value]
+        except KeyError:
+            fake = self._new_value(value)
+            if fake is None:
+                return default
+            self.values[value] = fake
+            if self.max_size and len(self.values) > self.max_size:
+                self._evict()
+        except TypeError:
+            # unhashable values can't be mapped
+            return default
+        else:
+            if self.max_size:
+                self.values.move_to_end(value)
+        return fake
+
+    def _new_value(self, value):
+        return self.provider()
+
+    def _evict(self):
+        if not self.evicted:
+            logging.warning("field map for {} reached {} values, forgetting least recently used values..."
+                            .format(self.name, self.max_size))
+        self.values.popitem(last=False)
+        self.evicted += 1
+
+    def __getitem__(self, value):
+        return self.get(value)
+
+    def __contains__(self, value):
+        return value in self.values
+
+    def __len__(self):
+        return len(self.values)
+
+    def __bool__(self):
+        # an empty lazy map still maps every value it is given
+        return True
+
+    def items(self):
+        return self.values.items()
+
+
+class PersistentFieldMap(LazyFieldMap):
+    """a lazy field map backed by a MappingStore
+
+    values are looked up in the store the first time they are seen, and only values the store doesn't know get a new
+    fake value, which is added to the store. since the store is the reference, forgetting values to stay under
+    max_size doesn't change the fake values that are used.
+    """
+
+    def __init__(self, store, field, provider, max_size=None):
+        super().__init__(provider, max_size, name=field)
+        self.store = store
+
+    def _new_value(self, value):
+        fake = self.store.lookup(self.name, value)
+        if fake is None:
+            fake = self.store.insert(self.name, value, self.provider())
+        return fake
+
+    def _evict(self):
+        self.values.popitem(last=False)
+        self.evicted += 1
+
+
+class DeterministicFieldMap:
+    """a field map whose fake values are a pure function of the original value and a key
+
+    before each fake value is generated, the faker instance is seeded from a keyed hash of the original value, so the
+    same value always gets the same fake value for the same key and provider, in any process or run. no table of
+    values is kept apart from a small LRU cache of recently used values.
+
+    :param faker: the faker instance the provider generates values with
+    :param provider: a callable using faker to return a fake value, e.g. faker.ipv4
+    :param hashkey: the key mixed into the hash, e.g. from utils.get_hashkey
+    :param cache_size: the number of recently used values to cache
+    """
+
+    def __init__(self, faker, provider, hashkey, cache_size=4096):
+        self.faker = faker
+        self.provider = provider
+        self.hashkey = hashkey
+        self.cache_size = cache_size
+        self.hasher = utils.Hasher(hashkey, cache_size=0)
+        self._cached_fake = functools.lru_cache(maxsize=cache_size)(self._fake)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_cached_fake']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._cached_fake = functools.lru_cache(maxsize=self.cache_size)(self._fake)
+
+    def _fake(self, value):
+        self.faker.seed_instance(int(self.hasher(value)[:16], 16))
+        return self.provider()
+
+    def get(self, value, default=None):
+        try:
+            return self._cached_fake(value)
+        except TypeError:
+            # unhashable values can't be mapped
+            return default
+
+    def __getitem__(self, value):
+        return self.get(value)
+
+    def __bool__(self):
+        return True
+
+
+# connections inherited from the main process by forked workers, see MappingStore.reconnect
+_forked_connections = []
+
+
+# the types of original values sqlite stores as they are
+_STORABLE_TYPES = (str, int, float, bytes)
+
+
+class MappingStore:
+    """an sqlite file of fake values keyed by (field, original value)
+
+    runs that share a store file reuse the fake values of earlier runs, and only generate fake values for original
+    values that haven't been seen before. stores can be shared by parallel workers: when two processes add a value at
+    the same time, the first one wins and both use its fake value.
+
+    :param path: the path of the sqlite file. it is created if it doesn't exist
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._connect()
+
+    def _connect(self):
+        # autocommit, so that values added by one worker are visible to the others right away
+        self.conn = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS mappings "
+                          "(field TEXT, original, fake, PRIMARY KEY (field, original)) WITHOUT ROWID")
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['conn'] = None
+        return state
+
+    def reconnect(self):
+        """open a new connection in a parallel worker
+
+        sqlite connections must not be used across fork. the inherited one is left open and unused, since closing it
+        could release locks or checkpoint the write-ahead log while the main process is using the file.
+        """
+        if self.conn is not None:
+            _forked_connections.append(self.conn)
+        self._connect()
+
+    def lookup(self, field, original):
+        """return the fake value stored for original, or None"""
+        try:
+            row = self.conn.execute("SELECT fake FROM mappings WHERE field = ? AND original = ?",
+                                    (field, original)).fetchone()
+        except sqlite3.InterfaceError:
+            # values sqlite can't store, like dicts, are never mapped
+            return None
+        return row[0] if row else None
+
+    def insert(self, field, original, fake):
+        """add a fake value for original, and return the fake value stored for it"""
+        try:
+            self.conn.execute("INSERT OR IGNORE INTO mappings (field, original, fake) VALUES (?, ?, ?)",
+                              (field, original, fake))
+        except sqlite3.InterfaceError:
+            return None
+        return self.lookup(field, original)
+
+    def fill(self, field, values, provider):
+        """add fake values for all the values of a field the store doesn't know yet, in a single transaction
+
+        the store is locked from reading the stored values until the new ones are added, so fake values added by
+        another process in between can't be overwritten.
+
+        :return: a dict of values and their stored fake values. values sqlite can't store, like tuples, are left out
+        """
+        values = [value for value in values if isinstance(value, _STORABLE_TYPES)]
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            stored = self.load(field)
+            new = {value: provider() for value in values if value not in stored}
+            self.conn.executemany("INSERT OR IGNORE INTO mappings (field, original, fake) VALUES (?, ?, ?)",
+                                  ((field, value, fake) for value, fake in new.items()))
+        except BaseException:
+            self.conn.execute("ROLLBACK")
+            raise
+        self.conn.execute("COMMIT")
+        stored.update(new)
+        return {value: stored[value] for value in values}
+
+    def load(self, field):
+        """return a dict of all the original values of a field and their fake values"""
+        return dict(self.conn.execute("SELECT original, fake FROM mappings WHERE field = ?", (field,)))
+
+    def field_map(self, field, provider, max_size=None):
+        return PersistentFieldMap(self, field, provider, max_size)
+
+    def count(self, field=None):
+        if field is None:
+            return self.conn.execute("SELECT COUNT(*) FROM mappings").fetchone()[0]
+        return self.conn.execute("SELECT COUNT(*) FROM mappings WHERE field = ?", (field,)).fetchone()[0]
+
+    def close(self):
+        self.conn.close()
+
+
+_MISSING = object()
+
+
+def _ipv4_int(value):
+    """return an ipv4 address in its usual dotted form as an int, or None"""
+    try:
+        packed = socket.inet_pton(socket.AF_INET, value)
+    except (OSError, ValueError):
+        return None
+    # only the usual form, so that each int stands for exactly one string
+    if socket.inet_ntoa(packed) != value:
+        return None
+    return int.from_bytes(packed, 'big')
+
+
+def _hash64(value):
+    return int.from_bytes(hashlib.blake2b(value.encode('utf-8', 'surrogatepass'), digest_size=8).digest(), 'little')
+
+
+class CompactFieldMap:
+    """a complete field map of original to fake values, stored in a few flat arrays instead of a dict of strings
+
+    ipv4 addresses are stored as 4 byte ints in a sorted array. other strings are kept in one utf-8 buffer indexed by
+    an array of offsets, and are found by binary search over a sorted array of their 64 bit hashes. fake values are
+    ipv4 ints if all of them are ipv4 addresses, and strings in a buffer otherwise, stored once however many values
+    map to them. this takes tens of bytes per value instead of a few hundred for a dict. the few values that are
+    neither, like numbers, are kept in a dict.
+
+    spill moves the arrays to a memory-mapped file, so that the operating system can page them out. a lookup takes a
+    few microseconds, so recently used values are cached.
+
+    :param items: an iterable of (original, fake) pairs, e.g. the items of a dict
+    :param name: the name of the field, used for logging
+    :param cache_size: the number of recently used values to cache
+    """
+
+    def __init__(self, items, name=None, cache_size=65536):
+        self.name = name
+        self.cache_size = cache_size
+        self._cached_lookup = functools.lru_cache(maxsize=cache_size, typed=True)(self._lookup)
+        self.path = None
+        self.other = {}
+        ips, strings, fakes, fake_slots = [], [], [], {}
+        for value, fake in items:
+            if type(value) is not str or type(fake) is not str:
+                self.other[value] = fake
+                continue
+            slot = fake_slots.get(fake)
+            if slot is None:
+                slot = fake_slots[fake] = len(fakes)
+                fakes.append(fake)
+            ip = _ipv4_int(value)
+            if ip is not None:
+                ips.append((ip, slot))
+            else:
+                strings.append((_hash64(value), value, slot))
+        ips.sort()
+        strings.sort(key=lambda entry: entry[0])
+        slot_type = 'I' if len(fakes) < 2 ** 32 else 'Q'
+
+        self.columns = {
+            'ip_keys': array('I', [ip for ip, _ in ips]),
+            'ip_slots': array(slot_type, [slot for _, slot in ips]),
+            'string_keys': array('Q', [key for key, _, _ in strings]),
+            'string_slots': array(slot_type, [slot for _, _, slot in strings]),
+        }
+        self._add_strings('originals', [value for _, value, _ in strings])
+        fake_ips = [_ipv4_int(fake) for fake in fakes]
+        self.ipv4_fakes = None not in fake_ips
+        if self.ipv4_fakes:
+            self.columns['fakes'] = array('I', fake_ips)
+        else:
+            self._add_strings('fakes', fakes)
+
+    def _add_strings(self, name, values):
+        encoded = [value.encode('utf-8', 'surrogatepass') for value in values]
+        offsets = array('Q', [0])
+        for value in encoded:
+            offsets.append(offsets[-1] + len(value))
+        self.columns[name + '_offsets'] = offsets
+        self.columns[name + '_data'] = b"".join(encoded)
+
+    def _string(self, name, i):
+        offsets = self.columns[name + '_offsets']
+        return str(self.columns[name + '_data'][offsets[i]:offsets[i + 1]], 'utf-8', 'surrogatepass')
+
+    def _fake(self, slot):
+        if self.ipv4_fakes:
+            return socket.inet_ntoa(self.columns['fakes'][slot].to_bytes(4, 'big'))
+        return self._string('fakes', slot)
+
+    @property
+    def nbytes(self):
+        """the size of the arrays, which are in memory unless spilled"""
+        return sum(len(column) * (column.itemsize if hasattr(column, 'itemsize') else 1)
+                   for column in self.columns.values())
+
+    def spill(self, directory=None):
+        """move the arrays to a memory-mapped file in directory, which is removed once the map is garbage collected"""
+        fd, self.path = tempfile.mkstemp(prefix='field-map-', suffix='.bin', dir=directory)
+        self.layout = []
+        with os.fdopen(fd, 'wb') as f:
+            for name, column in self.columns.items():
+                data = column.tobytes() if isinstance(column, array) else column
+                typecode = column.typecode if isinstance(column, array) else 'B'
+                self.layout.append((name, typecode, f.tell(), len(data)))
+                # 8 byte alignment for the arrays that follow
+                f.write(data + b"\0" * (-len(data) % 8))
+        weakref.finalize(self, os.remove, self.path)
+        self._map_file()
+        logging.info("field map for {} spilled to {}...".format(self.name, self.path))
+
+    def _map_file(self):
+        with open(self.path, 'rb') as f:
+            self.mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if os.path.getsize(self.path) else b""
+        view = memoryview(self.mmap)
+        self.columns = {name: view[start:start + size].cast(typecode)
+                        for name, typecode, start, size in self.layout}
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_cached_lookup']
+        if self.path:
+            # spilled maps are mapped again from the same file
+            state['columns'] = None
+            state['mmap'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._cached_lookup = functools.lru_cache(maxsize=self.cache_size, typed=True)(self._lookup)
+        if self.path:
+            self._map_file()
+
+    def get(self, value, default=None):
+        try:
+            fake = self._cached_lookup(value)
+        except TypeError:
+            # unhashable values can't be mapped
+            return default
+        return default if fake is _MISSING else fake
+
+    def _lookup(self, value):
+        if type(value) is not str:
+            return self.other.get(value, _MISSING)
+
+        columns = self.columns
+        if value.count('.') == 3:
+            ip = _ipv4_int(value)
+            if ip is not None:
+                keys = columns['ip_keys']
+                i = bisect_left(keys, ip)
+                if i < len(keys) and keys[i] == ip:
+                    return self._fake(columns['ip_slots'][i])
+                # addresses whose fake value isn't a string are kept with the other values
+                return self.other.get(value, _MISSING)
+
+        key = _hash64(value)
+        keys = columns['string_keys']
+        i = bisect_left(keys, key)
+        while i < len(keys) and keys[i] == key:
+            if self._string('originals', i) == value:
+                return self._fake(columns['string_slots'][i])
+            i += 1
+        return self.other.get(value, _MISSING)
+
+    def __getitem__(self, value):
+        return self.get(value)
+
+    def __contains__(self, value):
+        return self.get(value, _MISSING) is not _MISSING
+
+    def __len__(self):
+        return len(self.columns['ip_keys']) + len(self.columns['string_keys']) + len(self.other)
@@ -0,0 +1,268 @@
+"""counters, timers and latency histograms of a run, and profiling hooks
+
+an Anonymizer keeps a Metrics, which its reader and writer are given as their metrics attribute. metrics are counted
+per batch, or per rare event like a dropped document, so they are always on. at the end of a run they can be written
+as json or in the prometheus text format, and a callback can be given the metrics after every batch of a serial run.
+
+counters:
+    documents_read, documents_written, documents_dropped (dropped for keywords), fields_removed (removed for secrets),
+    bytes_written (json written by FSWriter, GCSWriter and ESWriter, or the size of closed parquet files)
+histograms, in seconds:
+    read_seconds, anonymize_seconds and write_seconds per batch, search_seconds per elasticsearch search request,
+    bulk_seconds per bulk request, transform_seconds per field, if transforms are timed, and mapping_seconds per field,
+    the time ESReader took to get the field's distinct values
+"""
+import bisect
+import collections
+import cProfile
+import json
+import logging
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+# upper bounds of histogram buckets in seconds, from 1ms to about 2 minutes
+BUCKETS = tuple(0.001 * 2 ** i for i in range(18))
+
+
+class MetricsError(Exception):
+    pass
+
+
+def _key(name, labels):
+    return (name, tuple(sorted(labels.items())))
+
+
+class Histogram:
+    """the count, sum and bucket counts of observed values"""
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def merge(self, other):
+        for i, count in enumerate(other.counts):
+            self.counts[i] += count
+        self.count += other.count
+        self.sum += other.sum
+
+    def quantile(self, q):
+        """estimate a quantile as the upper bound of the bucket it falls in"""
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            seen += count
+            if count and seen >= rank:
+                return bound
+        return 0.0
+
+    def summary(self):
+        return {
+            "count": self.count,
+            "sum": self.sum,
+            "mean": self.sum / self.count if self.count else 0.0,
+            "p50": self.quantile(0.5),
+            "p99": self.quantile(0.99),
+        }
+
+
+class Metrics:
+    """
+    :param callback: an optional callable, given the Metrics after every batch written
+    """
+
+    def __init__(self, callback=None):
+        self.callback = callback
+        self.counters = collections.defaultdict(int)
+        self.histograms = {}
+        self.lock = threading.Lock()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['lock'] = None
+        # callbacks, which may be lambdas, stay in the process they were given in
+        state['callback'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def count(self, name, value=1, **labels):
+        with self.lock:
+            self.counters[_key(name, labels)] += value
+
+    def observe(self, name, seconds, **labels):
+        key = _key(name, labels)
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(seconds)
+
+    @contextmanager
+    def timer(self, name, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def get(self, name, **labels):
+        """the value of a counter"""
+        return self.counters.get(_key(name, labels), 0)
+
+    def histogram(self, name, **labels):
+        return self.histograms.get(_key(name, labels))
+
+    def merge(self, other):
+        """add the metrics of another Metrics, e.g. of a parallel worker"""
+        with self.lock:
+            for key, value in other.counters.items():
+                self.counters[key] += value
+            for key, histogram in other.histograms.items():
+                self.histograms.setdefault(key, Histogram()).merge(histogram)
+
+    def batch_done(self):
+        if self.callback:
+            self.callback(self)
+
+    def summary(self):
+        """return the metrics as a json serializable dict"""
+        def name(key):
+            metric, labels = key
+            if not labels:
+                return metric
+            return "{}{{{}}}".format(metric, ",".join("{}={}".format(k, v) for k, v in labels))
+
+        return {
+            "counters": {name(key): value for key, value in sorted(self.counters.items())},
+            "histograms": {name(key): histogram.summary() for key, histogram in sorted(self.histograms.items())},
+        }
+
+    def to_json(self):
+        return json.dumps(self.summary(), indent=2)
+
+    def to_prometheus(self, prefix="anonymize_it"):
+        """return the metrics in the prometheus text exposition format"""
+        def labels(pairs, **extra):
+            pairs = list(pairs) + list(extra.items())
+            if not pairs:
+                return ""
+            return "{{{}}}".format(",".join('{}="{}"'.format(k, str(v).replace('"', '\\"')) for k, v in pairs))
+
+        lines = []
+        typed = set()
+        for (metric, pairs), value in sorted(self.counters.items()):
+            full_name = "{}_{}_total".format(prefix, metric)
+            if full_name not in typed:
+                typed.add(full_name)
+                lines.append("# TYPE {} counter".format(full_name))
+            lines.append("{}{} {}".format(full_name, labels(pairs), value))
+        for (metric, pairs), histogram in sorted(self.histograms.items()):
+            full_name = "{}_{}".format(prefix, metric)
+            if full_name not in typed:
+                typed.add(full_name)
+                lines.append("# TYPE {} histogram".format(full_name))
+            cumulative = 0
+            for bound, count in zip(histogram.buckets, histogram.counts):
+                cumulative += count
+                lines.append("{}_bucket{} {}".format(full_name, labels(pairs, le="{:g}".format(bound)), cumulative))
+            lines.append("{}_bucket{} {}".format(full_name, labels(pairs, le="+Inf"), histogram.count))
+            lines.append("{}_sum{} {}".format(full_name, labels(pairs), histogram.sum))
+            lines.append("{}_count{} {}".format(full_name, labels(pairs), histogram.count))
+        return "\n".join(lines) + "\n"
+
+    def log(self):
+        for key, value in self.summary()['counters'].items():
+            logging.info("{}: {}".format(key, value))
+        for key, histogram in self.summary()['histograms'].items():
+            logging.info("{}: {count} observations, mean {mean:.4f}s, p50 <= {p50:g}s, p99 <= {p99:g}s".format(
+                key, **histogram))
+
+    def dump(self, json_path=None, prometheus_path=None):
+        if json_path:
+            with open(json_path, 'w') as f:
+                f.write(self.to_json())
+        if prometheus_path:
+            with open(prometheus_path, 'w') as f:
+                f.write(self.to_prometheus())
+
+
+def timed(transform, metrics, field):
+    """wrap a transform so the time of each call is added to the transform_seconds histogram of its field"""
+    def transform_timed(value):
+        start = time.perf_counter()
+        try:
+            return transform(value)
+        finally:
+            metrics.observe('transform_seconds', time.perf_counter() - start, field=field)
+    return transform_timed
+
+
+class Sampler:
+    """a sampling profiler for the thread that starts it
+
+    every interval seconds, a background thread records the stack of the profiled thread. stacks are written in the
+    collapsed format read by flamegraph tools: one line per distinct stack, like "module:function;module:function 12"
+    """
+
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.stacks = collections.Counter()
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def _run(self, thread_id):
+        while not self.stop_event.wait(self.interval):
+            frame = sys._current_frames().get(thread_id)
+            stack = []
+            while frame is not None:
+                stack.append("{}:{}".format(frame.f_globals.get('__name__'), frame.f_code.co_name))
+                frame = frame.f_back
+            if stack:
+                self.stacks[";".join(reversed(stack))] += 1
+
+    def enable(self):
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self._run, args=(threading.get_ident(),), daemon=True)
+        self.thread.start()
+
+    def disable(self):
+        self.stop_event.set()
+        self.thread.join()
+
+    def dump_stats(self, path):
+        with open(path, 'w') as f:
+            for stack, count in self.stacks.most_common():
+                f.write("{} {}\n".format(stack, count))
+
+
+@contextmanager
+def profile(path, profiler='cprofile', interval=0.01):
+    """profile the code run in the with block, and write the results to path
+
+    :param profiler: cprofile, to write cProfile stats readable with pstats, or sampling, to write collapsed stacks
+        sampled every interval seconds with much less overhead
+    """
+    if profiler == 'cprofile':
+        prof = cProfile.Profile()
+    elif profiler == 'sampling':
+        prof = Sampler(interval)
+    else:
+        raise MetricsError("Invalid profiler {}. Choose cprofile/sampling".format(profiler))
+    prof.enable()
+    try:
+        yield prof
+    finally:
+        prof.disable()
+        prof.dump_stats(path)
+        logging.info("profile written to {}...".format(path))
@@ -0,0 +1,339 @@
+"""compiled secret, user and keyword matchers
+
+building the combined regexes is done once per set of settings and the result is cached, so that repeated runs in a
+process reuse the same matchers. registries are picklable, so parallel workers receive them ready to use.
+"""
+import collections
+import functools
+import json
+import os
+import re
+
+_registries = {}
+
+# characters that change the meaning of the atom before them
+_QUANTIFIERS = "?*+{"
+
+
+@functools.lru_cache(maxsize=None)
+def _read_secret_regexes():
+    with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), "secret_regexes.json"), "r") as f:
+        return json.load(f)
+
+
+def load_secret_regexes():
+    """load the secret regexes shipped with anonymize-it. the file is only read once per process"""
+    return dict(_read_secret_regexes())
+
+
+def _class_end(pattern, start):
+    # index of the "]" closing the character class opened at start
+    i = start + 1
+    if pattern[i:i + 1] == "^":
+        i += 1
+    if pattern[i:i + 1] == "]":
+        i += 1
+    while i < len(pattern) and pattern[i] != "]":
+        i += 2 if pattern[i] == "\\" else 1
+    return i
+
+
+def _group_end(pattern, start):
+    # index of the ")" closing the group opened at start, and whether the group alternates at its top level
+    depth = 0
+    alternates = False
+    i = start
+    while i < len(pattern):
+        c = pattern[i]
+        if c == "\\":
+            i += 1
+        elif c == "[":
+            i = _class_end(pattern, i)
+        elif c == "(":
+            depth += 1
+        elif c == ")":
+            depth -= 1
+            if depth == 0:
+                return i, alternates
+        elif c == "|" and depth == 1:
+            alternates = True
+        i += 1
+    return i, alternates
+
+
+# inline flags at the start of a pattern, like (?i), which apply to all of it
+_GLOBAL_FLAGS = re.compile(r"\(\?([aiLmsux]+)\)")
+# escapes longer than a backslash and one character: \xHH, \uHHHH, \UHHHHHHHH, \N{name}, octal escapes like \0 or \101,
+# and backreferences like \12
+_LONG_ESCAPE = re.compile(r"\\(x[0-9a-fA-F]{2}|u[0-9a-fA-F]{4}|U[0-9a-fA-F]{8}|N\{[^}]*\}"
+                          r"|0[0-7]{0,2}|[0-7]{3}|[1-9][0-9]?)")
+
+
+def required_literal(pattern):
+    """find a literal that every match of a regex must contain
+
+    the pattern is read as a sequence of atoms, and the longest run of unquantified literal characters is returned.
+    a character class of exactly one letter in both cases, like [aA], counts as that letter matched without case, and
+    so does the whole literal if the pattern starts with (?i). patterns with alternation outside of a group, or that
+    start with (?x), where whitespace and # aren't literal, have no required literal.
+
+    :return: a tuple (literal, ignorecase), or (None, False)
+    """
+    flags = ""
+    i = 0
+    match = _GLOBAL_FLAGS.match(pattern)
+    while match:
+        flags += match.group(1)
+        i = match.end()
+        match = _GLOBAL_FLAGS.match(pattern, i)
+    if "x" in flags:
+        return None, False
+
+    runs = []
+    run = []
+    ignorecase = False
+    while i < len(pattern):
+        c = pattern[i]
+        literal = None
+        caseless = False
+        if c == "|":
+            return None, False
+        elif c == ")":
+            # the end of a group that was read inline
+            i += 1
+            continue
+        elif c == "(":
+            end, alternates = _group_end(pattern, i)
+            quantified = pattern[end + 1:end + 2] in tuple(_QUANTIFIERS)
+            if alternates or quantified or pattern.startswith("(?", i) and not pattern.startswith("(?:", i):
+                i = end + 1
+            else:
+                # a plain group is part of the sequence around it
+                i += 3 if pattern.startswith("(?:", i) else 1
+                continue
+        elif c == "\\":
+            escaped = pattern[i + 1:i + 2]
+            if escaped and not escaped.isalnum():
+                literal = escaped
+                i += 2
+            else:
+                # escapes of letters and digits aren't read as literals, and end the run as a whole
+                match = _LONG_ESCAPE.match(pattern, i)
+                i = match.end() if match else i + 2
+        elif c == "[":
+            end = _class_end(pattern, i)
+            body = pattern[i + 1:end]
+            members = set(body)
+            if "\\" in body or body.startswith("^"):
+                pass
+            elif len(members) == 1:
+                literal = body[0]
+            elif len(members) == 2 and members == {min(members).lower(), min(members).upper()}:
+                literal = min(members).lower()
+                caseless = True
+            i = end + 1
+        elif c == "{":
+            i = pattern.find("}", i) + 1 or len(pattern)
+        elif c in ".^$" or c in _QUANTIFIERS:
+            i += 1
+        else:
+            literal = c
+            i += 1
+
+        if literal is not None and pattern[i:i + 1] in ("?", "*", "{"):
+            literal = None
+        if literal is None:
+            runs.append(("".join(run), ignorecase))
+            run = []
+            ignorecase = False
+        else:
+            run.append(literal)
+            ignorecase = ignorecase or caseless
+            if pattern[i:i + 1] == "+":
+                # a repeated literal is still required once, but ends the run
+                runs.append(("".join(run), ignorecase))
+                run = []
+                ignorecase = False
+    runs.append(("".join(run), ignorecase))
+
+    literal, ignorecase = max(runs, key=lambda r: len(r[0]))
+    if not literal:
+        return None, False
+    return literal, ignorecase or "i" in flags
+
+
+class PrefilteredPattern:
+    """a combined regex that skips values which can't match
+
+    patterns with a required literal of at least min_anchor characters only run when one of the literals is found
+    in the value with a plain substring check. search() and sub() behave like those of the combined regex.
+    """
+
+    def __init__(self, patterns, flags=0, min_anchor=3):
+        patterns = list(dict.fromkeys(patterns))
+        self.regex = re.compile('|'.join(patterns), flags)
+
+        anchored = []
+        unanchored = []
+        self.anchors = set()
+        self.caseless_anchors = set()
+        for pattern in patterns:
+            # in verbose patterns, literal characters may be whitespace or comments
+            literal, ignorecase = required_literal(pattern) if not flags & re.VERBOSE else (None, False)
+            if literal is None or len(literal) < min_anchor:
+                unanchored.append(pattern)
+            elif ignorecase or flags & re.IGNORECASE:
+                self.caseless_anchors.add(literal.casefold())
+                anchored.append(pattern)
+            else:
+                self.anchors.add(literal)
+                anchored.append(pattern)
+
+        self.anchored_regex = re.compile('|'.join(anchored), flags) if anchored else None
+        self.unanchored_regex = re.compile('|'.join(unanchored), flags) if unanchored else None
+
+    def might_match(self, value):
+        """cheap check of whether the anchored patterns could match value"""
+        if any(anchor in value for anchor in self.anchors):
+            return True
+        if self.caseless_anchors:
+            folded = value.casefold()
+            return any(anchor in folded for anchor in self.caseless_anchors)
+        return False
+
+    def search(self, value):
+        if self.unanchored_regex:
+            match = self.unanchored_regex.search(value)
+            if match:
+                return match
+        if self.anchored_regex and self.might_match(value):
+            return self.anchored_regex.search(value)
+        return None
+
+    def sub(self, repl, value):
+        if self.unanchored_regex or self.might_match(value):
+            return self.regex.sub(repl, value)
+        return value
+
+
+def _is_word_char(ch):
+    return ch.isalnum() or ch == "_"
+
+
+class KeywordIndex:
+    """a keyword matcher that scans each value in a single pass
+
+    keywords are compiled into an Aho-Corasick automaton, so the cost of a search depends on the length of the value
+    and not on the number of keywords. for a handful of keywords, plain substring checks are faster and are used
+    instead.
+
+    :param keywords: a list of keywords
+    :param ignorecase: match keywords regardless of case
+    :param whole_word: only match keywords that are not part of a longer word
+    :param min_automaton_size: the number of keywords from which the automaton is used
+    """
+
+    def __init__(self, keywords, ignorecase=False, whole_word=False, min_automaton_size=100):
+        self.ignorecase = ignorecase
+        self.whole_word = whole_word
+        self.keywords = list(dict.fromkeys(k.casefold() if ignorecase else k for k in keywords))
+        # like the in operator, an empty keyword is found in every value
+        self.matches_everything = "" in self.keywords and not whole_word
+        self.use_automaton = whole_word or len(self.keywords) >= min_automaton_size
+        if self.use_automaton:
+            self._build()
+
+    def _build(self):
+        # goto[state] maps a character to the next state, out[state] holds the lengths of keywords ending at state
+        goto = [{}]
+        out = [()]
+        for keyword in self.keywords:
+            if not keyword:
+                continue
+            state = 0
+            for ch in keyword:
+                if ch not in goto[state]:
+                    goto.append({})
+                    out.append(())
+                    goto[state][ch] = len(goto) - 1
+                state = goto[state][ch]
+            out[state] = (len(keyword),)
+
+        # breadth first, so fail links always point to states that are already complete
+        fail = [0] * len(goto)
+        queue = collections.deque(goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for ch, child in goto[state].items():
+                queue.append(child)
+                link = fail[state]
+                while link and ch not in goto[link]:
+                    link = fail[link]
+                fail[child] = goto[link].get(ch, 0)
+                out[child] = out[child] + out[fail[child]]
+
+        self.goto = goto
+        self.fail = fail
+        self.out = out
+        self.alphabet = frozenset(ch for keyword in self.keywords for ch in keyword)
+
+    def _is_whole_word(self, text, end, length):
+        start = end - length + 1
+        if start > 0 and _is_word_char(text[start - 1]):
+            return False
+        if end + 1 < len(text) and _is_word_char(text[end + 1]):
+            return False
+        return True
+
+    def search(self, value):
+        """return True if value contains any of the keywords"""
+        if self.matches_everything:
+            return True
+        text = value.casefold() if self.ignorecase else value
+        if not self.use_automaton:
+            return any(keyword in text for keyword in self.keywords)
+
+        goto, fail, out, alphabet = self.goto, self.fail, self.out, self.alphabet
+        state = 0
+        for i, ch in enumerate(text):
+            if ch not in alphabet:
+                state = 0
+                continue
+            while state and ch not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(ch, 0)
+            if out[state]:
+                if not self.whole_word:
+                    return True
+                if any(self._is_whole_word(text, i, length) for length in out[state]):
+                    return True
+        return False
+
+
+class PatternRegistry:
+    """the combined matchers used on sensitive fields
+
+    :param secret_regexes: a dict like {'secret.name': 'regex'}. fields matching any of these are removed
+    :param user_regexes: a dict like {'regex.name': 'regex'}. matches are replaced with the regex's first group
+    :param keywords: a list of keywords. documents containing any of these are dropped
+    :param keyword_options: options for the KeywordIndex, like {'ignorecase': True, 'whole_word': True}
+    """
+
+    def __init__(self, secret_regexes, user_regexes=None, keywords=None, keyword_options=None):
+        self.secrets = PrefilteredPattern(secret_regexes.values())
+        self.users = None
+        self.keywords = None
+        if user_regexes:
+            self.users = PrefilteredPattern(user_regexes.values(), flags=re.MULTILINE|re.IGNORECASE)
+        if keywords:
+            self.keywords = KeywordIndex(keywords, **(keyword_options or {}))
+
+
+def get_registry(secret_regexes, user_regexes=None, keywords=None, keyword_options=None):
+    """return the registry for these settings, building it the first time they are seen"""
+    key = (tuple(secret_regexes.items()), tuple((user_regexes or {}).items()), tuple(keywords or []),
+           tuple(sorted((keyword_options or {}).items())))
+    registry = _registries.get(key)
+    if registry is None:
+        registry = _registries[key] = PatternRegistry(secret_regexes, user_regexes, keywords, keyword_options)
+    return registry
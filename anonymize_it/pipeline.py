@@ -0,0 +1,168 @@
+"""a staged pipeline that overlaps reading, anonymizing and writing
+
+documents are read in batches on a reader thread, anonymized on the calling thread, and written on a writer thread.
+stages hand batches to each other through bounded queues, so a slow stage makes the others wait instead of buffering
+an unbounded number of batches.
+"""
+import logging
+import queue
+import threading
+import time
+from . import utils
+
+_DONE = object()
+
+
+class StageStats:
+    """counters for one stage of a pipeline
+
+    busy is the time spent doing the stage's work, waiting is the time spent waiting for input or for room in the
+    next stage's queue. the stage with the most busy time is the bottleneck.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.batches = 0
+        self.items = 0
+        self.busy = 0.0
+        self.waiting = 0.0
+
+    @property
+    def throughput(self):
+        """items per busy second"""
+        return self.items / self.busy if self.busy else 0.0
+
+    def __str__(self):
+        return "{}: {} items in {} batches, {:.2f}s busy, {:.2f}s waiting, {:.0f} items/s".format(
+            self.name, self.items, self.batches, self.busy, self.waiting, self.throughput)
+
+
+class Pipeline:
+    """
+    :param read_queue: the number of read batches that can wait to be anonymized
+    :param write_queue: the number of anonymized batches that can wait to be written
+    :param batch_size: the number of documents per batch
+    """
+
+    def __init__(self, read_queue=4, write_queue=4, batch_size=10000):
+        self.read_queue = read_queue
+        self.write_queue = write_queue
+        self.batch_size = batch_size
+        self.stats = {}
+
+    def _put(self, q, item, stop):
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _get(self, q, stop):
+        while not stop.is_set():
+            try:
+                return q.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        return _DONE
+
+    def _read(self, data, out_queue, stop, errors, metrics):
+        stats = self.stats['read']
+        try:
+            start = time.time()
+            for batchiter in utils.batch(data, self.batch_size):
+                batch = list(batchiter)
+                ready = time.time()
+                stats.busy += ready - start
+                stats.batches += 1
+                stats.items += len(batch)
+                if metrics:
+                    metrics.observe('read_seconds', ready - start)
+                if not self._put(out_queue, batch, stop):
+                    return
+                start = time.time()
+                stats.waiting += start - ready
+        except Exception as e:
+            errors.append(e)
+        finally:
+            self._put(out_queue, _DONE, stop)
+
+    def _write(self, in_queue, write, stop, errors, on_written, metrics):
+        stats = self.stats['write']
+        try:
+            while True:
+                start = time.time()
+                batch = self._get(in_queue, stop)
+                ready = time.time()
+                stats.waiting += ready - start
+                if batch is _DONE:
+                    return
+                write(batch)
+                done = time.time()
+                stats.busy += done - ready
+                if metrics:
+                    metrics.observe('write_seconds', done - ready)
+                stats.batches += 1
+                stats.items += len(batch)
+                if on_written:
+                    on_written(stats.items)
+        except Exception as e:
+            errors.append(e)
+            stop.set()
+
+    def run(self, data, transform, write, on_written=None, metrics=None):
+        """run the pipeline until data is exhausted
+
+        :param data: an iterable of documents
+        :param transform: a callable taking a list of documents and returning the list of records to write
+        :param write: a callable writing a list of records, e.g. a writer's write_data
+        :param on_written: an optional callable given the total number of records written after each batch
+        :param metrics: an optional metrics.Metrics, given the time each stage spends on each batch
+        :return: the number of records written
+        """
+        self.stats = {name: StageStats(name) for name in ("read", "transform", "write")}
+        read_queue = queue.Queue(self.read_queue)
+        write_queue = queue.Queue(self.write_queue)
+        stop = threading.Event()
+        errors = []
+
+        reader = threading.Thread(target=self._read, args=(data, read_queue, stop, errors, metrics), daemon=True)
+        writer = threading.Thread(target=self._write, args=(write_queue, write, stop, errors, on_written, metrics),
+                                  daemon=True)
+        reader.start()
+        writer.start()
+
+        stats = self.stats['transform']
+        try:
+            while True:
+                start = time.time()
+                batch = self._get(read_queue, stop)
+                ready = time.time()
+                stats.waiting += ready - start
+                if batch is _DONE:
+                    break
+                records = transform(batch)
+                done = time.time()
+                stats.busy += done - ready
+                if metrics:
+                    metrics.observe('anonymize_seconds', done - ready)
+                stats.batches += 1
+                stats.items += len(batch)
+                if not self._put(write_queue, records, stop):
+                    break
+                stats.waiting += time.time() - done
+            self._put(write_queue, _DONE, stop)
+        except BaseException:
+            stop.set()
+            raise
+        finally:
+            writer.join()
+            stop.set()
+            reader.join()
+
+        if errors:
+            raise errors[0]
+        for stage in self.stats.values():
+            logging.info(str(stage))
+        return self.stats['write'].items
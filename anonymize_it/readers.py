@@ -1,19 +1,77 @@
 from abc import ABCMeta, abstractmethod
 from elasticsearch import Elasticsearch
+from elasticsearch.exceptions import SerializationError
+from elasticsearch.serializer import JSONSerializer
 from elasticsearch_dsl import Search, A
+from elasticsearch_dsl.response import Hit
+from concurrent.futures import ThreadPoolExecutor
 import getpass
+import glob
+import gzip
+import io
+import json
+import mmap
+import os
+import time
 from . import utils
 import logging
 
+try:
+    import numpy
+    import pandas
+except ImportError:
+    numpy = None
+    pandas = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import orjson
+    json_loads = orjson.loads
+except ImportError:
+    json_loads = json.loads
+
 
 class ESReaderError(Exception):
     pass
 
 
+# the parts of search and scroll responses used by raw scans
+RAW_FILTER_PATH = "_scroll_id,pit_id,hits.hits._index,hits.hits._id,hits.hits._source,hits.hits.sort"
+
+
+class FastJSONSerializer(JSONSerializer):
+    """parses responses with orjson when it is installed, which is several times faster than json for search pages
+
+    unlike json, orjson parses integers that don't fit in 64 bits as floats.
+    """
+
+    def loads(self, s):
+        try:
+            return json_loads(s)
+        except (ValueError, TypeError) as e:
+            # orjson rejects some json that json accepts, like unpaired surrogates
+            try:
+                return json.loads(s)
+            except (ValueError, TypeError):
+                raise SerializationError(s, e)
+
+
 class ProviderInferenceError(Exception):
     pass
 
 
+class PandasReaderError(Exception):
+    pass
+
+
+class NDJSONReaderError(Exception):
+    pass
+
+
 def es_field_mappings(es_type, field):
     es_types = {
         "text": [],
@@ -48,7 +106,79 @@ def es_field_mappings(es_type, field):
     return field
 
 
+def pit_scan(es, index, body, size=1000, keep_alive='5m', search_after=None, metrics=None, raw=False):
+    """scan all hits of a search using a point in time and search_after
+
+    an alternative to scroll for elasticsearch 7.12 and later. hits are returned in _shard_doc order, and each hit's
+    meta.sort is the search_after position to resume after it.
+
+    :param body: the search body, including any query, _source filtering or slice
+    :param search_after: the meta.sort of the hit to start after
+    :param metrics: an optional metrics.Metrics, given the time of each search request
+    :param raw: if true, hits are returned as the dicts of the response instead of Hit objects, and responses are cut
+        down to what's needed with filter_path. their sort is the search_after position
+    """
+    params = {"filter_path": RAW_FILTER_PATH} if raw else {}
+    pit_id = es.open_point_in_time(index=index, keep_alive=keep_alive)['id']
+    try:
+        while True:
+            page = dict(body, size=size, sort=["_shard_doc"], track_total_hits=False,
+                        pit={"id": pit_id, "keep_alive": keep_alive})
+            if search_after:
+                page['search_after'] = search_after
+            start = time.perf_counter()
+            response = es.search(body=page, **params)
+            if metrics:
+                metrics.observe('search_seconds', time.perf_counter() - start)
+            pit_id = response.get('pit_id', pit_id)
+            # filter_path leaves out the hits of an empty page
+            hits = response.get('hits', {}).get('hits', [])
+            if raw:
+                yield from hits
+            else:
+                for hit in hits:
+                    yield Hit(hit)
+            if len(hits) < size:
+                return
+            search_after = hits[-1]['sort']
+    finally:
+        es.close_point_in_time(body={"id": pit_id})
+
+
+def raw_scroll(es, index, body, size=1000, keep_alive='5m', metrics=None):
+    """scroll through all hits of a search, returning hits as the dicts of the response
+
+    like elasticsearch_dsl's Search.scan, without building a Hit for every hit. responses are cut down to the index,
+    id, _source and sort of hits with filter_path.
+
+    :param body: the search body, including any query, _source filtering or slice
+    """
+    body = dict(body, sort=body.get('sort', ["_doc"]))
+    start = time.perf_counter()
+    response = es.search(index=index, body=body, scroll=keep_alive, size=size, filter_path=RAW_FILTER_PATH)
+    scroll_id = response.get('_scroll_id')
+    try:
+        while True:
+            if metrics:
+                metrics.observe('search_seconds', time.perf_counter() - start)
+            hits = response.get('hits', {}).get('hits', [])
+            if not hits:
+                return
+            yield from hits
+            start = time.perf_counter()
+            response = es.scroll(body={"scroll_id": scroll_id, "scroll": keep_alive}, filter_path=RAW_FILTER_PATH)
+            scroll_id = response.get('_scroll_id', scroll_id)
+    finally:
+        if scroll_id:
+            es.clear_scroll(body={"scroll_id": [scroll_id]}, ignore=(404,))
+
+
 class BaseReader:
+    # readers that set this can return dataframes from get_frames, which are anonymized a column at a time
+    vectorized = False
+    # a metrics.Metrics set by the anonymizer
+    metrics = None
+
     def __init__(self, params, masked_fields, suppressed_fields):
         self.masked_fields = masked_fields
         self.suppressed_fields = suppressed_fields
@@ -56,12 +186,16 @@ class BaseReader:
         logging.info("masked_fields = {}".format(self.masked_fields))
         logging.info("suppressed_fields = {}".format(self.suppressed_fields))
 
+    def reconnect(self):
+        """open new connections in a parallel worker, which can't use those of the main process"""
+        pass
+
     @abstractmethod
     def create_mappings(self):
         pass
 
     @abstractmethod
-    def get_data(self, field_maps, suppressed_fields, include_all):
+    def get_data(self, include_all=False, slice_id=None, max_slices=None):
         pass
 
     @abstractmethod
@@ -79,6 +213,17 @@ class ESReader(BaseReader):
         self.query = params.get('query')
         self.use_ssl = params.get('use_ssl', False)
         self.auth = params.get('auth')
+        self.slices = params.get('slices', 1)
+        self.page_size = params.get('page_size', 1000)
+        self.keep_alive = params.get('keep_alive', '5m')
+        self.pagination = params.get('pagination', 'scroll')
+        self.mapping_threads = params.get('mapping_threads', 4)
+        self.fields_per_request = params.get('fields_per_request', 1)
+        self.raw_hits = params.get('raw_hits', False)
+        self.fast_json = params.get('fast_json', True)
+
+        if self.pagination not in ('scroll', 'pit'):
+            raise ESReaderError("pagination must be one of scroll/pit. please check config.")
 
         if self.auth == 'native':
             self.username = getpass.getpass('elasticsearch username: ')
@@ -94,53 +239,116 @@ class ESReader(BaseReader):
         elif not all([self.host, self.apiKey]):
                 raise ESReaderError("elasticsearch configuration malformed. please check config.")
 
-        if self.auth == 'native':
-            self.es = Elasticsearch([self.host], use_ssl=self.use_ssl, http_auth=(self.username, self.password), verify_certs=False)
-        else:
-            self.es = Elasticsearch([self.host], api_key=self.apiKey, use_ssl=self.use_ssl)
+        self.es = self._connect()
 
         logging.info("elasticsearch host = {}".format(self.host))
         logging.info("elasticsearch index = {}".format(self.index_pattern))
         logging.info("using query = {}".format(self.query))
 
+    def _connect(self):
+        # responses are parsed with orjson when it is installed
+        serializers = {"application/json": FastJSONSerializer()} if self.fast_json else None
+        if self.auth == 'native':
+            return Elasticsearch([self.host], use_ssl=self.use_ssl, http_auth=(self.username, self.password),
+                                 verify_certs=False, serializers=serializers)
+        return Elasticsearch([self.host], api_key=self.apiKey, use_ssl=self.use_ssl, serializers=serializers)
+
+    def __getstate__(self):
+        # the elasticsearch client holds connection pools and locks, so worker processes open their own connection
+        state = self.__dict__.copy()
+        state['es'] = None
+        return state
+
+    def reconnect(self):
+        # forked workers inherit the client of the main process and its open sockets, which they must not share
+        self.es = self._connect()
+
     def create_mappings(self):
         logging.info("creating mappings...")
-        mappings = {}
-        for field, provider in self.masked_fields.items():
-            logging.info("getting values for {} using provider {}".format(field, provider))
-            mappings[field] = {}
-            cont = True
-            term = ""
-            size = 10000
-            if provider:
-                while cont:
-                    response = self.es.search(index=self.index_pattern,
-                                              body=utils.composite_query(field, size, self.query, term))
-                    for hit in response['aggregations']['my_buckets']['buckets']:
-                        mappings[field][hit['key'][field]] = None
-                    if len(response['aggregations']["my_buckets"]['buckets']) < size:
-                        cont = False
-                    if not len(response['aggregations']["my_buckets"]['buckets']) == 0:
-                        term = response['aggregations']["my_buckets"]['buckets'][-1]['key'][field]
+        mappings = {field: {} for field in self.masked_fields}
+        fields = [field for field, provider in self.masked_fields.items() if provider]
+        groups = [fields[i:i + self.fields_per_request] for i in range(0, len(fields), self.fields_per_request)]
+
+        # each group of fields is paged through on its own thread
+        with ThreadPoolExecutor(max_workers=self.mapping_threads) as pool:
+            for values in pool.map(self.field_values, groups):
+                mappings.update(values)
 
         logging.info("mappings completed...")
         return mappings
 
+    def field_values(self, fields):
+        """page through the distinct values of fields, using one composite aggregation per field in each request
+
+        :return: a dict of {field: {value: None}}
+        """
+        logging.info("getting values for {}".format(", ".join(fields)))
+        size = 10000
+        values = {field: {} for field in fields}
+        after = {}
+        remaining = list(fields)
+        seconds = {field: 0.0 for field in fields}
+        while remaining:
+            start = time.perf_counter()
+            response = self.es.search(index=self.index_pattern,
+                                      body=utils.multi_composite_query(remaining, size, self.query, after))
+            # the fields of a request share its time equally
+            share = (time.perf_counter() - start) / len(remaining)
+            for i, field in enumerate(list(remaining)):
+                start = time.perf_counter()
+                agg = response['aggregations'][str(i)]
+                for hit in agg['buckets']:
+                    values[field][hit['key'][field]] = None
+                seconds[field] += share + time.perf_counter() - start
+                if len(agg['buckets']) < size or 'after_key' not in agg:
+                    remaining.remove(field)
+                    logging.info("got {} values for {} in {:.2f}s".format(len(values[field]), field, seconds[field]))
+                    if self.metrics:
+                        self.metrics.observe('mapping_seconds', seconds[field], field=field)
+                else:
+                    after[field] = agg['after_key']
+        return values
+
     def get_count(self):
         s = Search(using=self.es, index=self.index_pattern)
         if self.query:
             s.update_from_dict({"query": self.query})
         return s.count()
 
-    def get_data(self, include_all=False):
+    def add_range(self, field, gt=None, lte=None):
+        """only read documents whose field is greater than gt and at most lte, e.g. a window of @timestamp"""
+        bounds = {key: value for key, value in (("gt", gt), ("lte", lte)) if value is not None}
+        time_range = {"range": {field: bounds}}
+        self.query = {"bool": {"filter": [self.query, time_range] if self.query else [time_range]}}
+        logging.info("using query = {}".format(self.query))
+
+    def get_data(self, include_all=False, slice_id=None, max_slices=None, search_after=None):
         """
-        :param field_maps:
-        :param suppressed_fields:
-        :param include_all:
-        :return:
+        :param include_all: if true, return all fields except suppressed fields
+        :param slice_id: the slice of the scan to return when the scan is split across workers
+        :param max_slices: the number of slices the scan is split into
+        :param search_after: with pit pagination, the meta.sort of the hit to resume after
+        :return: an iterable of hits, which are dicts like {"_index": ..., "_source": {...}} if the reader has raw_hits
+            set. if the reader is configured with more than one slice and no slice is requested, all slices are read in
+            parallel threads, each with its own connection, and their hits are merged
         """
+        logging.info("gathering data from elasticsearch...")
 
-        s = Search(using=self.es, index=self.index_pattern)
+        if max_slices and max_slices > 1:
+            return self.get_slice(include_all, slice_id, max_slices, search_after=search_after)
+        if self.slices > 1:
+            logging.info("reading {} slices in parallel...".format(self.slices))
+            slices = [self.get_slice(include_all, i, self.slices, es=self._connect()) for i in range(self.slices)]
+            return utils.merge_threaded(slices, self.page_size * self.slices)
+        return self.get_slice(include_all, search_after=search_after)
+
+    def get_slice(self, include_all=False, slice_id=None, max_slices=None, es=None, search_after=None):
+        """return the hits of one slice of the scan
+
+        :param es: the elasticsearch client to use, defaults to the reader's client
+        """
+        es = es or self.es
+        s = Search(using=es, index=self.index_pattern)
         if self.query:
             s.update_from_dict({"query": self.query})
 
@@ -149,10 +357,17 @@ class ESReader(BaseReader):
         else:
             s = s.source(excludes=self.suppressed_fields)
 
-        logging.info("gathering data from elasticsearch...")
+        if max_slices and max_slices > 1:
+            s = s.extra(slice={"id": slice_id, "max": max_slices})
 
-        response = s.scan()
-        return response
+        if self.pagination == 'pit':
+            return pit_scan(es, self.index_pattern, s.to_dict(), self.page_size, self.keep_alive, search_after,
+                            self.metrics, raw=self.raw_hits)
+        if search_after:
+            raise ESReaderError("resuming a scan after a hit requires pit pagination")
+        if self.raw_hits:
+            return raw_scroll(es, self.index_pattern, s.to_dict(), self.page_size, self.keep_alive, self.metrics)
+        return s.params(scroll=self.keep_alive, size=self.page_size).scan()
 
     def infer_providers(self):
 
@@ -173,23 +388,374 @@ class ESReader(BaseReader):
         print(self.masked_fields)
 
 
-class CSVReader(BaseReader):
-    def __init__(self, params):
-        super().__init__(params)
+def _arrays_to_lists(frame):
+    # list columns of parquet files are read as numpy arrays, which aren't hashable and hash differently than lists.
+    # a column is converted when its first value is an array
+    columns = []
+    for column in frame.columns[frame.dtypes == object]:
+        index = frame[column].first_valid_index()
+        if index is not None and isinstance(frame[column].loc[index], numpy.ndarray):
+            columns.append(column)
+    if not columns:
+        return frame
+    frame = frame.copy()
+    for column in columns:
+        frame[column] = frame[column].map(lambda v: v.tolist() if isinstance(v, numpy.ndarray) else v)
+    return frame
 
-    def get_data(self, field_maps, suppressed_fields, include_all):
-        pass
+
+class PandasReader(BaseReader):
+    """reads documents from a pandas dataframe, or a file pandas can read, in chunks of chunk_size rows
+
+    columns are fields, named like the flattened fields of elasticsearch documents (e.g. host.name), and null cells
+    are left out of documents. besides get_data, chunks can be read as dataframes with get_frames, which the anonymizer
+    anonymizes a column at a time.
+
+    a file is read whole by each pass over the data: by create_mappings in faker mode, and by get_data or get_frames.
+    the number of rows is kept from the first pass, so get_count only reads the file if nothing was read before.
+
+    :param params: a dict with
+        dataframe: the dataframe to read, when the reader is created in python
+        path, format (parquet): a file to read instead, in a format pandas has a read_<format> function for, like
+            parquet, feather, pickle or json (json lines)
+        chunk_size (10000): number of rows per chunk
+    """
+    vectorized = True
+
+    def __init__(self, params, masked_fields, suppressed_fields):
+        super().__init__(params, masked_fields, suppressed_fields)
+        if pandas is None:
+            raise PandasReaderError("file readers require the pandas package")
+
+        self.type = 'pandas'
+        self.dataframe = params.get('dataframe')
+        self.path = params.get('path')
+        self.format = params.get('format', 'parquet')
+        self.chunk_size = params.get('chunk_size', 10000)
+        self.es = None
+        self.row_count = None
+
+        if self.dataframe is None and not self.path:
+            raise PandasReaderError("pandas reader configuration malformed. please check config.")
+
+    def read_chunks(self, usecols=None):
+        """yield the data as dataframes of at most chunk_size rows
+
+        :param usecols: a callable returning true for the names of the columns to read, or None to read all columns
+        """
+        frame = self.dataframe
+        if frame is None:
+            options = {"lines": True} if self.format == 'json' else {}
+            frame = getattr(pandas, "read_" + self.format)(self.path, **options)
+            self.row_count = len(frame)
+        if usecols:
+            frame = frame[[column for column in frame.columns if usecols(column)]]
+        for start in range(0, len(frame), self.chunk_size):
+            yield _arrays_to_lists(frame.iloc[start:start + self.chunk_size])
+
+    def _usecols(self, include_all):
+        suppressed = set(self.suppressed_fields or [])
+        if include_all:
+            return lambda column: column not in suppressed
+        return lambda column: column in self.masked_fields and column not in suppressed
+
+    def create_mappings(self):
+        logging.info("creating mappings...")
+        mappings = {field: {} for field in self.masked_fields}
+        fields = [field for field, provider in self.masked_fields.items() if provider]
+        for chunk in self.read_chunks(usecols=lambda column: column in fields):
+            for field in chunk.columns:
+                values = chunk[field].dropna()
+                try:
+                    mappings[field].update(dict.fromkeys(values.unique()))
+                except TypeError:
+                    # like terms aggregations, lists contribute each of their values
+                    for value in values:
+                        if isinstance(value, numpy.ndarray):
+                            value = value.tolist()
+                        mappings[field].update(dict.fromkeys(value if isinstance(value, list) else [value]))
+        logging.info("mappings completed...")
+        return mappings
+
+    def get_count(self):
+        if self.dataframe is not None:
+            return len(self.dataframe)
+        if self.row_count is None:
+            self.row_count = sum(len(chunk) for chunk in self.read_chunks())
+        return self.row_count
+
+    def get_frames(self, include_all=False, slice_id=None, max_slices=None):
+        """
+        :param include_all: if true, return all columns except suppressed fields
+        :param slice_id: the slice to return when the data is split across workers. chunks are dealt to slices in turn
+        :param max_slices: the number of slices the data is split into
+        :return: an iterable of dataframes
+        """
+        for i, chunk in enumerate(self.read_chunks(usecols=self._usecols(include_all))):
+            if max_slices and max_slices > 1 and i % max_slices != slice_id:
+                continue
+            yield chunk
+
+    def get_data(self, include_all=False, slice_id=None, max_slices=None):
+        for chunk in self.get_frames(include_all, slice_id, max_slices):
+            for record in utils.frame_records(chunk):
+                yield Hit({"_source": record})
 
     def infer_providers(self):
         pass
 
 
-class PandasReader(BaseReader):
-    def __init__(self, params):
-        super().__init__(params)
+class CSVReader(PandasReader):
+    """streams documents from csv files in chunks of chunk_size rows
 
-    def get_data(self, field_maps, suppressed_fields, include_all):
-        pass
+    values are read as strings unless dtype is set, so that a value is the same in every chunk and maps to the same
+    fake value. empty cells are left out of documents. each parallel worker parses all files and keeps its own chunks.
+
+    :param params: a dict with
+        path: a csv file, a directory of .csv files, or a glob pattern
+        chunk_size (10000): number of rows per chunk
+        delimiter (,), encoding (utf-8): passed to pandas.read_csv
+        dtype (str): the dtype of columns, or infer to let pandas infer the dtype of each column in each chunk
+    """
+
+    def __init__(self, params, masked_fields, suppressed_fields):
+        super().__init__(params, masked_fields, suppressed_fields)
+        self.type = 'csv'
+        self.delimiter = params.get('delimiter', ',')
+        self.encoding = params.get('encoding', 'utf-8')
+        self.dtype = params.get('dtype', 'str')
+
+        if os.path.isdir(self.path):
+            self.paths = sorted(glob.glob(os.path.join(self.path, '*.csv')))
+        else:
+            self.paths = sorted(glob.glob(self.path))
+        if not self.paths:
+            raise PandasReaderError("no csv files found at {}".format(self.path))
+        logging.info("reading {} csv files...".format(len(self.paths)))
+
+    def read_chunks(self, usecols=None):
+        for path in self.paths:
+            yield from pandas.read_csv(path, sep=self.delimiter, encoding=self.encoding, usecols=usecols,
+                                       dtype=None if self.dtype == 'infer' else self.dtype,
+                                       chunksize=self.chunk_size)
+
+    def get_count(self):
+        return sum(len(chunk) for chunk in self.read_chunks(usecols=[0]))
+
+
+class NDJSONReader(BaseReader):
+    """reads documents from newline delimited json files, without a cluster
+
+    a line of a plain file can be a document, or a hit as dumped by elasticdump or copied from search responses (its
+    _source is read). a bulk file is a bulk request body, where action lines like {"index": {...}} alternate with
+    document lines. whether a file is a bulk file is decided once, from its first line, unless the bulk param says so.
+    files can be gzip (.gz) or zstd (.zst) compressed. uncompressed plain files are memory mapped and split into byte
+    ranges when the data is split across workers, while compressed and bulk files are dealt to workers whole.
+
+    :param params: a dict with
+        path: a file, a directory of .json/.ndjson/.jsonl files (optionally .gz or .zst), or a glob pattern
+        bulk (optional): true if all files are bulk request bodies, false if none are. by default, a file is a bulk
+            file if its first line is a bulk action
+    """
+    extensions = ('.json', '.ndjson', '.jsonl')
+    actions = ('index', 'create', 'update', 'delete')
+    # the metadata bulk actions can have, so that documents like {"index": {"name": ...}} aren't taken for actions
+    action_keys = frozenset(('_index', '_id', '_type', '_routing', 'routing', 'pipeline', 'require_alias', 'version',
+                             'version_type', 'if_seq_no', 'if_primary_term', 'retry_on_conflict', 'dynamic_templates'))
+
+    def __init__(self, params, masked_fields, suppressed_fields):
+        super().__init__(params, masked_fields, suppressed_fields)
+        self.type = 'ndjson'
+        self.path = params.get('path')
+        self.bulk = params.get('bulk')
+        self.es = None
+        self._bulk_files = {}
+
+        if not self.path:
+            raise NDJSONReaderError("ndjson reader configuration malformed. please check config.")
+        if os.path.isdir(self.path):
+            self.paths = sorted(os.path.join(self.path, name) for name in os.listdir(self.path)
+                                if name.endswith(tuple(ext + comp for ext in self.extensions
+                                                       for comp in ('', '.gz', '.zst')))
+                                and not name.endswith('-manifest.json'))
+        else:
+            self.paths = sorted(glob.glob(self.path))
+        if not self.paths:
+            raise NDJSONReaderError("no ndjson files found at {}".format(self.path))
+        if zstandard is None and any(path.endswith('.zst') for path in self.paths):
+            raise NDJSONReaderError("reading .zst files requires the zstandard package")
+        logging.info("reading {} ndjson files...".format(len(self.paths)))
+
+    def _open(self, path):
+        if path.endswith('.gz'):
+            return gzip.open(path, 'rb')
+        if path.endswith('.zst'):
+            return io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(open(path, 'rb')))
+        return open(path, 'rb')
+
+    def read_lines(self, path, slice_id=None, max_slices=None):
+        """yield the lines of a file, or of the byte range slice_id of max_slices of an uncompressed file
+
+        a line belongs to the range its first byte is in.
+        """
+        if path.endswith(('.gz', '.zst')):
+            with self._open(path) as f:
+                yield from f
+            return
+
+        with open(path, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            if not size:
+                return
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                start, end = 0, size
+                if max_slices and max_slices > 1:
+                    start, end = size * slice_id // max_slices, size * (slice_id + 1) // max_slices
+                if start:
+                    # skip the rest of the line that started in the previous range
+                    mm.seek(start - 1)
+                    mm.readline()
+                while mm.tell() < end:
+                    yield mm.readline()
+
+    def _parts(self, slice_id=None, max_slices=None):
+        whole = 0
+        for path in self.paths:
+            if not (max_slices and max_slices > 1):
+                yield path, None, None
+            elif path.endswith(('.gz', '.zst')) or self.is_bulk(path):
+                # a byte range of a bulk file can't tell action lines from document lines
+                if whole % max_slices == slice_id:
+                    yield path, None, None
+                whole += 1
+            else:
+                yield path, slice_id, max_slices
+
+    def _is_action(self, doc):
+        if len(doc) != 1:
+            return False
+        action, meta = next(iter(doc.items()))
+        return action in self.actions and isinstance(meta, dict) and self.action_keys.issuperset(meta)
+
+    def is_bulk(self, path):
+        """whether a file is a bulk request body, from the bulk param or else from the first line of the file"""
+        if self.bulk is not None:
+            return self.bulk
+        if path not in self._bulk_files:
+            bulk = False
+            with self._open(path) as f:
+                for line in f:
+                    if line.strip():
+                        try:
+                            doc = json_loads(line)
+                        except ValueError:
+                            break
+                        bulk = isinstance(doc, dict) and self._is_action(doc)
+                        break
+            self._bulk_files[path] = bulk
+        return self._bulk_files[path]
+
+    def _docs(self, path, lines):
+        for line in lines:
+            if not line.strip():
+                continue
+            try:
+                doc = json_loads(line)
+            except ValueError as e:
+                raise NDJSONReaderError("invalid json in {}: {}".format(path, e))
+            if not isinstance(doc, dict):
+                raise NDJSONReaderError("lines of {} should be json objects".format(path))
+            yield doc
+
+    def _bulk_hits(self, path, docs):
+        """yield the documents of a bulk request body, whose lines are an action and, except for deletes, a document"""
+        action = None
+        for doc in docs:
+            if action is None:
+                if not self._is_action(doc):
+                    raise NDJSONReaderError("expected a bulk action in {}, got {}".format(path, list(doc)[:5]))
+                action, meta = next(iter(doc.items()))
+                if action == 'delete':
+                    action = None
+                continue
+            if action == 'update':
+                # the partial document of an update, scripted updates have none
+                doc = doc.get('doc')
+            if isinstance(doc, dict):
+                hit = {key: meta[key] for key in ('_index', '_id') if key in meta}
+                hit['_source'] = doc
+                yield hit
+            action = None
+
+    def hits(self, slice_id=None, max_slices=None):
+        """yield every document as a dict with a _source, and the _index and _id of hits where they are known"""
+        for path, part_id, max_parts in self._parts(slice_id, max_slices):
+            docs = self._docs(path, self.read_lines(path, part_id, max_parts))
+            if self.is_bulk(path):
+                yield from self._bulk_hits(path, docs)
+                continue
+            for doc in docs:
+                yield doc if '_source' in doc else {"_source": doc}
+
+    def _keep(self, field, include_all):
+        for suppressed in self.suppressed_fields or []:
+            if field == suppressed or field.startswith(suppressed + '.'):
+                return False
+        return include_all or field in self.masked_fields
+
+    def create_mappings(self):
+        logging.info("creating mappings...")
+        mappings = {field: {} for field in self.masked_fields}
+        fields = [field for field, provider in self.masked_fields.items() if provider]
+        for hit in self.hits():
+            doc = utils.flatten_nest(hit['_source'])
+            for field in fields:
+                value = doc.get(field)
+                if value is None:
+                    continue
+                # like terms aggregations, lists contribute each of their values
+                for v in value if isinstance(value, list) else [value]:
+                    try:
+                        mappings[field][v] = None
+                    except TypeError:
+                        pass
+        logging.info("mappings completed...")
+        return mappings
+
+    def get_count(self):
+        """the number of lines, halved for bulk files. used to report progress
+
+        lines are counted without parsing them, but compressed files are decompressed for this an extra time.
+        """
+        total = 0
+        for path in self.paths:
+            lines = 0
+            last = b'\n'
+            with self._open(path) as f:
+                for block in iter(lambda: f.read(1024 * 1024), b''):
+                    lines += block.count(b'\n')
+                    last = block[-1:]
+            if last != b'\n':
+                # the last line has no newline
+                lines += 1
+            total += lines // 2 if self.is_bulk(path) else lines
+        return total
+
+    def get_data(self, include_all=False, slice_id=None, max_slices=None):
+        """
+        :param include_all: if true, return all fields except suppressed fields
+        :param slice_id: the slice to return when the data is split across workers
+        :param max_slices: the number of slices the data is split into
+        :return: an iterable of hits, which are dicts like {"_index": ..., "_source": {...}}
+        """
+        logging.info("gathering data from {}...".format(self.path))
+        filtered = not include_all or self.suppressed_fields
+        for hit in self.hits(slice_id, max_slices):
+            if filtered:
+                source = {field: value for field, value in utils.flatten_nest(hit['_source']).items()
+                          if self._keep(field, include_all)}
+                hit = dict(hit, _source=source)
+            yield hit
 
     def infer_providers(self):
         pass
@@ -198,6 +764,7 @@ class PandasReader(BaseReader):
 reader_mapping = {
     "elasticsearch": ESReader,
     "csv": CSVReader,
-    "pandas": PandasReader
+    "pandas": PandasReader,
+    "ndjson": NDJSONReader
 }
 
@@ -0,0 +1,71 @@
+"""serializers of anonymized documents to json
+
+writers that set accepts_bytes are given each document as utf-8 json bytes by serializers that make bytes, and join a
+batch into one write. other writers, like ESWriter, are given json strings.
+
+json is the default. the orjson serializer is several times faster, and is chosen by name, or by auto when orjson is
+installed. it writes compact json without escaping non-ascii characters, so its output differs from json.dumps byte
+for byte, and it writes the floats NaN and Infinity as null, where json.dumps writes NaN and Infinity.
+"""
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+class SerializerError(Exception):
+    pass
+
+
+class JSONSerializer:
+    """the standard library json module"""
+    name = 'json'
+    # json makes strings, which writers join and encode a batch at a time faster than they are encoded one by one
+    binary = False
+
+    def dumps(self, doc):
+        return json.dumps(doc).encode()
+
+    def dumps_text(self, doc):
+        return json.dumps(doc)
+
+
+class OrjsonSerializer:
+    """orjson, which serializes straight to bytes and is several times faster than json
+
+    documents orjson can't serialize, like integers wider than 64 bits, are serialized with json instead. NaN and
+    infinite floats are written as null.
+    """
+    name = 'orjson'
+    binary = True
+
+    def __init__(self):
+        if orjson is None:
+            raise SerializerError("the orjson serializer requires the orjson package")
+
+    def dumps(self, doc):
+        try:
+            return orjson.dumps(doc, option=orjson.OPT_NON_STR_KEYS)
+        except TypeError:
+            return json.dumps(doc).encode()
+
+    def dumps_text(self, doc):
+        return self.dumps(doc).decode()
+
+
+serializer_mapping = {
+    "json": JSONSerializer,
+    "orjson": OrjsonSerializer,
+}
+
+
+def get_serializer(name='json'):
+    """:param name: json, orjson, or auto for orjson when it is installed and json otherwise"""
+    if name == 'auto':
+        name = 'orjson' if orjson is not None else 'json'
+    serializer = serializer_mapping.get(name)
+    if not serializer:
+        raise SerializerError("Invalid serializer {}. Choose auto/json/orjson".format(name))
+    return serializer()
@@ -0,0 +1,72 @@
+"""per-field transforms used by compiled anonymization plans
+
+a plan is a dict of {'field.name': transform}, where a transform takes the value of a field and returns the new value,
+DROP_FIELD if the field should be removed, or DROP_DOCUMENT if the whole document should be dropped.
+"""
+from . import utils
+
+DROP_FIELD = object()
+DROP_DOCUMENT = object()
+
+
+def map_values(field_map):
+    def transform(value):
+        if type(value) == list:
+            # Since this is a list we need to sub out every item
+            return [field_map.get(f, "This should not happen (list)!!!") for f in value]
+        return field_map.get(value, "This should not happen!!!")
+    return transform
+
+
+def high_cardinality(choices):
+    def transform(value):
+        return choices[len(value) % len(choices)]
+    return transform
+
+
+def hash_values(hasher):
+    """:param hasher: a utils.Hasher"""
+    def transform(value):
+        if type(value) == list:
+            return hasher.hash_many(value)
+        return hasher(value)
+    return transform
+
+
+def drop_document_if_keywords(matcher):
+    def transform(value):
+        # keyword matchers are searched the same way as secret regexes
+        if utils.contains_secret(matcher, value):
+            return DROP_DOCUMENT
+        return value
+    return transform
+
+
+def drop_field_if_secret(regex):
+    def transform(value):
+        if utils.contains_secret(regex, value):
+            return DROP_FIELD
+        return value
+    return transform
+
+
+def scrub(regex):
+    def transform(value):
+        if type(value) == list:
+            return [regex.sub(r"\1", f) for f in value]
+        return regex.sub(r"\1", value)
+    return transform
+
+
+def chain(steps):
+    """combine transforms into one, stopping at the first one that drops the field or document"""
+    if len(steps) == 1:
+        return steps[0]
+
+    def transform(value):
+        for step in steps:
+            value = step(value)
+            if value is DROP_FIELD or value is DROP_DOCUMENT:
+                return value
+        return value
+    return transform
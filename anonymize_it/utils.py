@@ -5,8 +5,14 @@ from elasticsearch.client import LicenseClient
 import json
 import faker
 import hashlib
+from functools import lru_cache
 import getpass
+import logging
+import os
 import requests
+import queue
+import threading
+import time
 
 try:
     # Import ABC from collections.abc for Python 3.4+
@@ -19,15 +25,68 @@ class ConfigParserError(Exception):
 class CloudAPIError(Exception):
     pass
 
+HASHKEY_ENV = 'ANONYMIZE_IT_HASHKEY'
+HASHKEY_FILE_ENV = 'ANONYMIZE_IT_HASHKEY_FILE'
+HASHKEY_CACHE_ENV = 'ANONYMIZE_IT_HASHKEY_CACHE'
+# cached hashkeys are looked up again after a day
+HASHKEY_TTL = 24 * 60 * 60
+
+# values that are never mappings, checked before the slower MutableMapping check
+_LEAF_TYPES = (str, int, float, list, type(None))
+
+
 def flatten_nest(d, parent_key='', sep='.'):
-    items = []
-    for k, v in d.items():
-        new_key = parent_key + sep + k if parent_key else k
-        if isinstance(v, MutableMapping):
-            items.extend(flatten_nest(v, new_key, sep=sep).items())
+    """flatten nested objects into a single dict with keys like 'a.b.c', in the order the fields appear
+
+    objects are walked with a stack of iterators instead of recursion, and keys are built once per field. lists,
+    including lists of objects, are values and are kept as they are, so unflatten_nest restores the original document.
+    """
+    flat = {}
+    stack = [(parent_key + sep if parent_key else '', iter(d.items()))]
+    while stack:
+        prefix, items = stack[-1]
+        for k, v in items:
+            if isinstance(v, dict) or (not isinstance(v, _LEAF_TYPES) and isinstance(v, MutableMapping)):
+                stack.append((prefix + k + sep, iter(v.items())))
+                break
+            flat[prefix + k if prefix else k] = v
         else:
-            items.append((new_key, v))
-    return dict(items)
+            stack.pop()
+    return flat
+
+def unflatten_nest(d, sep='.'):
+    """restore the nested objects of a document flattened with flatten_nest
+
+    a key that can't be nested, because another key holds a value at one of its parents, like 'a.b' next to 'a', is
+    kept with its remaining dots under the deepest object it can be nested in. the result doesn't depend on the order
+    of the keys.
+    """
+    nested = {}
+    for key, value in d.items():
+        if sep not in key:
+            nested[key] = value
+            continue
+        parts = key.split(sep)
+        node = nested
+        path = None
+        for i, part in enumerate(parts[:-1]):
+            path = part if path is None else path + sep + part
+            if path in d:
+                # a value of its own, which the rest of the key can't be nested in
+                node[sep.join(parts[i:])] = value
+                break
+            child = node.get(part)
+            if child is None:
+                child = node[part] = {}
+            node = child
+        else:
+            node[parts[-1]] = value
+    return nested
+
+def frame_records(frame):
+    """convert a dataframe to a list of documents, leaving out null values"""
+    return [{k: v for k, v in record.items() if v is not None and v == v}
+            for record in frame.to_dict('records')]
 
 def parse_config(config):
     """first pass parsing of config file
@@ -41,6 +100,11 @@ def parse_config(config):
     suppressed_fields = config.get('exclude')
     include_rest = config.get('include_rest')
     sensitive = config.get('sensitive')
+    workers = config.get('workers', 1)
+    mappings = config.get('mappings')
+    pipeline = config.get('pipeline')
+    checkpoint = config.get('checkpoint')
+    metrics = config.get('metrics')
 
     if not source:
         raise ConfigParserError("source error: source not defined. Please check config.")
@@ -58,8 +122,8 @@ def parse_config(config):
     if not writer_type:
         raise ConfigParserError("destination error: dest type not defined. Please check config.")
 
-    Config = collections.namedtuple('Config', 'source dest anonymization_type masked_fields suppressed_fields include_rest sensitive')
-    config = Config(source, dest, anonymization_type, masked_fields, suppressed_fields, include_rest, sensitive)
+    Config = collections.namedtuple('Config', 'source dest anonymization_type masked_fields suppressed_fields include_rest sensitive workers mappings pipeline checkpoint metrics')
+    config = Config(source, dest, anonymization_type, masked_fields, suppressed_fields, include_rest, sensitive, workers, mappings, pipeline, checkpoint, metrics)
     return config
 
 def batch(iterable, size):
@@ -71,6 +135,52 @@ def batch(iterable, size):
         except StopIteration:
             return
 
+def merge_threaded(iterables, max_queued=1000):
+    """consume each iterable in its own thread, and yield their items in the order they arrive
+
+    :param max_queued: the maximum number of items waiting to be consumed, so fast producers wait for the consumer
+    """
+    items = queue.Queue(max_queued)
+    stop = threading.Event()
+    finished = object()
+
+    def put(entry):
+        while not stop.is_set():
+            try:
+                items.put(entry, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def consume(iterable):
+        try:
+            for item in iterable:
+                if not put((None, item)):
+                    return
+        except Exception as e:
+            put((e, None))
+        finally:
+            put((finished, None))
+
+    threads = [threading.Thread(target=consume, args=(iterable,), daemon=True) for iterable in iterables]
+    for thread in threads:
+        thread.start()
+
+    remaining = len(threads)
+    try:
+        while remaining:
+            error, item = items.get()
+            if error is finished:
+                remaining -= 1
+            elif error is not None:
+                raise error
+            else:
+                yield item
+    finally:
+        # stop producers if the consumer stops early or fails
+        stop.set()
+
 def faker_examples():
     providers = []
     examples = []
@@ -100,7 +210,8 @@ def get_license_info(es):
         return
     return license_info
 
-def get_hashkey(es):
+def lookup_hashkey(es):
+    """derive the hashkey from the cluster's license, asking the cloud deployments api for the owner id on elastic cloud"""
     license_info = get_license_info(es)
     if not license_info:
         return
@@ -126,6 +237,73 @@ def get_hashkey(es):
         # For non-production clusters, the customer name is returned as "Company XYZ (non-production environments)"
         return license_info.split('(')[0].strip()
 
+def hashkey_cache_path():
+    return os.environ.get(HASHKEY_CACHE_ENV, os.path.join(os.path.expanduser('~'), '.anonymize_it', 'hashkeys.json'))
+
+def read_hashkey_cache(path, cluster_uuid):
+    """return the unexpired hashkey cached for cluster_uuid, or None"""
+    try:
+        if os.stat(path).st_mode & 0o077:
+            logging.warning("ignoring hashkey cache {}, which can be read by other users".format(path))
+            return
+        with open(path, 'r') as f:
+            entry = json.load(f).get(cluster_uuid)
+    except (OSError, ValueError):
+        return
+    if entry and entry.get('expires', 0) > time.time():
+        return entry.get('hashkey')
+
+def write_hashkey_cache(path, cluster_uuid, hashkey, ttl):
+    """cache hashkey for cluster_uuid in a file only the current user can read"""
+    try:
+        with open(path, 'r') as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        cache = {}
+    now = time.time()
+    cache = {uuid: entry for uuid, entry in cache.items() if entry.get('expires', 0) > now}
+    cache[cluster_uuid] = {"hashkey": hashkey, "expires": now + ttl}
+
+    os.makedirs(os.path.dirname(path) or '.', mode=0o700, exist_ok=True)
+    tmp_path = "{}.{}.tmp".format(path, os.getpid())
+    with os.fdopen(os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'w') as f:
+        json.dump(cache, f)
+    os.replace(tmp_path, path)
+
+def get_hashkey(es, cache_path=None, ttl=HASHKEY_TTL):
+    """return the key mixed into hashes, looking it up as little as possible
+
+    the hashkey is taken from, in order:
+        the ANONYMIZE_IT_HASHKEY environment variable
+        the file named by the ANONYMIZE_IT_HASHKEY_FILE environment variable
+        the hashkey cache, where keys are kept for ttl seconds per cluster uuid
+        lookup_hashkey, whose result is added to the cache
+
+    :param cache_path: the cache file, defaults to ANONYMIZE_IT_HASHKEY_CACHE or ~/.anonymize_it/hashkeys.json
+    :param ttl: seconds a cached key is used for, 0 to disable the cache
+    """
+    if os.environ.get(HASHKEY_ENV):
+        return os.environ[HASHKEY_ENV]
+    if os.environ.get(HASHKEY_FILE_ENV):
+        with open(os.environ[HASHKEY_FILE_ENV], 'r') as f:
+            return f.read().strip()
+    # readers of files have no cluster to derive a hashkey from
+    if es is None:
+        return
+
+    cache_path = cache_path or hashkey_cache_path()
+    cluster_uuid = es.info().get('cluster_uuid') if ttl else None
+    if cluster_uuid:
+        hashkey = read_hashkey_cache(cache_path, cluster_uuid)
+        if hashkey:
+            logging.info("using cached hashkey for cluster {}...".format(cluster_uuid))
+            return hashkey
+
+    hashkey = lookup_hashkey(es)
+    if hashkey and cluster_uuid:
+        write_hashkey_cache(cache_path, cluster_uuid, hashkey, ttl)
+    return hashkey
+
 def contains_secret(regex, field_value):
     if type(field_value) == list:
         for f in field_value:
@@ -148,22 +326,102 @@ def contains_keywords(field_value, keywords):
 def hash_value(hashkey, field_value):
     return hashlib.sha256(f"{hashkey}:{field_value}".encode()).hexdigest()
 
+class Hasher:
+    """hash_value for one hashkey, with the hashes of recent values cached
+
+    values that repeat, like user or host names, are only hashed once. only strings, ints, bools and None are cached,
+    since values of other types can be equal without having the same text, like 0.0 and -0.0, and would be given
+    each other's hashes.
+
+    :param hashkey: the key mixed into every hash
+    :param cache_size: the number of recent values whose hashes are cached, 0 to disable the cache
+    """
+
+    def __init__(self, hashkey, cache_size=65536):
+        self.hashkey = hashkey
+        self.cache_size = cache_size
+        self._setup()
+
+    def _setup(self):
+        # typed, so that 1 and True are hashed as "1" and "True"
+        self._cached = lru_cache(maxsize=self.cache_size, typed=True)(self._hash) if self.cache_size else self._hash
+
+    def __getstate__(self):
+        # caches can't be pickled, so workers start their own
+        state = self.__dict__.copy()
+        del state['_cached']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._setup()
+
+    def _hash(self, value):
+        return hashlib.sha256(f"{self.hashkey}:{value}".encode()).hexdigest()
+
+    def __call__(self, value):
+        if value.__class__ in _CACHED_TYPES:
+            return self._cached(value)
+        return self._hash(value)
+
+    def hash_many(self, values):
+        """hash a batch of values, hashing each distinct value once"""
+        hashes = {}
+        out = []
+        for value in values:
+            if value.__class__ not in _CACHED_TYPES:
+                out.append(self._hash(value))
+                continue
+            # keyed by type too, so that 1 and True aren't taken for the same value
+            key = (value.__class__, value)
+            h = hashes.get(key)
+            if h is None:
+                h = hashes[key] = self(value)
+            out.append(h)
+        return out
+
+
+# types whose equal values always have the same text, so their hashes can be cached
+_CACHED_TYPES = frozenset((str, int, bool, type(None)))
+
+def composite_agg(field, size, term=""):
+    agg = {
+        "composite": {
+            "size": size,
+            "sources" : [
+                {field: {"terms": {"field": field}}}
+            ]
+        }
+    }
+    if term:
+        agg["composite"]["after"] = {field: term}
+    return agg
+
 def composite_query(field, size, query=None, term=""):
     body= {
             "size": 0,
             "aggs": {
-                "my_buckets": {
-                    "composite": {
-                        "size": size,
-                        "sources" : [
-                            {field: {"terms": {"field": field}}}
-                        ]
-                    }
-                }
+                "my_buckets": composite_agg(field, size, term)
             }
         }
-    if term:
-        body["aggs"]["my_buckets"]["composite"]["after"] = {field: term}
+    if query:
+        body['query'] = query
+    return json.dumps(body)
+
+def multi_composite_query(fields, size, query=None, after=None):
+    """a composite aggregation per field, so the distinct values of several fields are paged in one request
+
+    aggregations are named by the position of their field in fields.
+
+    :param after: a dict of {field: after_key} for fields that are past their first page
+    """
+    after = after or {}
+    aggs = {}
+    for i, field in enumerate(fields):
+        aggs[str(i)] = composite_agg(field, size)
+        if field in after:
+            aggs[str(i)]["composite"]["after"] = after[field]
+    body = {"size": 0, "aggs": aggs}
     if query:
         body['query'] = query
     return json.dumps(body)
@@ -1,12 +1,52 @@
 from abc import abstractmethod, ABCMeta
+from concurrent.futures import ThreadPoolExecutor
+from elasticsearch import Elasticsearch, helpers
+import collections
+import copy
+import getpass
+import gzip
+import hashlib
 import json
+import logging
 import uuid
 import os
+import re
+import time
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
 
 from google.cloud import storage
+from google.cloud.storage import retry
+
+
+class WriterError(Exception):
+    pass
+
+
+def encode_lines(data):
+    """join a batch of json documents, given as bytes or as strings, into newline delimited bytes"""
+    if type(data[0]) is bytes:
+        return b"\n".join(data) + b"\n"
+    return "\n".join(data).encode() + b"\n"
 
 
 class BaseWriter(metaclass=ABCMeta):
+    # writers that set this are given documents as flat dicts instead of json strings
+    accepts_dicts = False
+    # writers that set this are given documents as json bytes instead of strings, see serializers.py
+    accepts_bytes = False
+    # a metrics.Metrics set by the anonymizer
+    metrics = None
+
     def __init__(self, params):
         self.type = params.get('type')
 
@@ -14,50 +54,582 @@ class BaseWriter(metaclass=ABCMeta):
     def write_data(self, data, file_name=None):
         pass
 
+    def open(self):
+        """prepare the destination. called once by the main process before a run writes any data"""
+        pass
+
+    def reconnect(self):
+        """open new connections in a parallel worker, which can't use those of the main process"""
+        pass
+
+    def for_shard(self, shard_id):
+        """return the writer a parallel worker uses for its shard of the data"""
+        return self
+
+    def flush(self):
+        """wait until all data written so far is stored. called by every process that wrote data"""
+        pass
+
+    def checkpoint(self):
+        """return a json serializable state to resume writing from, called right after flush"""
+        return {}
+
+    def restore(self, state):
+        """resume writing from a state returned by checkpoint, discarding anything written after it"""
+        pass
+
+    def close(self):
+        """finish the run. called once by the main process after all data is written"""
+        pass
+
 
 class ESWriter(BaseWriter):
+    """writes documents to an elasticsearch index with the bulk api
+
+    batches are split into bulk requests of at most chunk_size documents and max_chunk_bytes bytes, which are sent by
+    bulk_threads threads sharing a connection pool. documents rejected with a 429 are retried with exponential backoff.
+
+    :param params: a dict with
+        host, index, use_ssl: the destination cluster and index
+        auth: native to be prompted for a username and password, api for an api key, or none
+        chunk_size (500), max_chunk_bytes (10MB): limits of one bulk request
+        bulk_threads (4): number of bulk requests in flight
+        max_retries (5), initial_backoff (2), max_backoff (600): retries of rejected documents, in seconds
+        optimize_settings (false): disable refreshes and replicas while loading, and restore them on close
+        refresh (true): refresh the index once all data is written
+    """
+
     def __init__(self, params):
         super().__init__(params)
+        self.type = 'elasticsearch'
+        self.host = params.get('host')
+        self.index = params.get('index')
+        self.use_ssl = params.get('use_ssl', False)
+        self.auth = params.get('auth')
+        self.chunk_size = params.get('chunk_size', 500)
+        self.max_chunk_bytes = params.get('max_chunk_bytes', 10 * 1024 * 1024)
+        self.bulk_threads = params.get('bulk_threads', 4)
+        self.max_retries = params.get('max_retries', 5)
+        self.initial_backoff = params.get('initial_backoff', 2)
+        self.max_backoff = params.get('max_backoff', 600)
+        self.optimize_settings = params.get('optimize_settings', False)
+        self.refresh = params.get('refresh', True)
+
+        if not all([self.host, self.index]):
+            raise WriterError("elasticsearch writer configuration malformed. please check config.")
+
+        self.http_auth = None
+        self.api_key = None
+        if self.auth == 'native':
+            self.http_auth = (getpass.getpass('destination elasticsearch username: '),
+                              getpass.getpass('destination elasticsearch password: '))
+        elif self.auth == 'api':
+            self.api_key = getpass.getpass('destination elasticsearch ApiKey: ')
+
+        self.original_settings = None
+        self._connect()
+
+    def _connect(self):
+        # one pooled connection per bulk thread
+        self.es = Elasticsearch([self.host], use_ssl=self.use_ssl, http_auth=self.http_auth, api_key=self.api_key,
+                                maxsize=self.bulk_threads)
+        self.pool = ThreadPoolExecutor(max_workers=self.bulk_threads)
+        self.pending = collections.deque()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for attr in ('es', 'pool', 'pending'):
+            state[attr] = None
+        return state
+
+    def reconnect(self):
+        # forked workers inherit the client and bulk threads of the main process, which they can't use
+        self._connect()
+
+    def open(self):
+        if not self.optimize_settings:
+            return
+        load_settings = {"refresh_interval": "-1", "number_of_replicas": 0}
+        if self.es.indices.exists(index=self.index):
+            settings = self.es.indices.get_settings(index=self.index)[self.index]['settings']['index']
+            self.original_settings = {key: settings.get(key) for key in load_settings}
+            self.es.indices.put_settings(index=self.index, body={"index": load_settings})
+        else:
+            # None restores the defaults
+            self.original_settings = {key: None for key in load_settings}
+            self.es.indices.create(index=self.index, body={"settings": {"index": load_settings}})
+
+    def _bulk(self, data):
+        start = time.perf_counter()
+        errors = []
+        for ok, item in helpers.streaming_bulk(self.es, data, index=self.index, chunk_size=self.chunk_size,
+                                               max_chunk_bytes=self.max_chunk_bytes, max_retries=self.max_retries,
+                                               initial_backoff=self.initial_backoff, max_backoff=self.max_backoff,
+                                               raise_on_error=False, yield_ok=False):
+            errors.append(item)
+        if errors:
+            raise WriterError("{} documents failed to index, first error: {}".format(len(errors), errors[0]))
+        if self.metrics:
+            self.metrics.observe('bulk_seconds', time.perf_counter() - start)
+            # documents are json strings, whose utf-8 encoding is what the bulk request sends
+            self.metrics.count('bytes_written', sum(len(doc.encode()) if type(doc) is str else len(doc)
+                                                    for doc in data))
+        return len(data)
+
+    def write_data(self, data, file_name=None):
+        # wait for the oldest batch when too many are in flight, so the writer applies backpressure
+        while len(self.pending) >= self.bulk_threads:
+            self.pending.popleft().result()
+        self.pending.append(self.pool.submit(self._bulk, data))
+
+    def flush(self):
+        while self.pending:
+            self.pending.popleft().result()
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            # settings are restored even when documents failed to index
+            try:
+                if self.original_settings:
+                    self.es.indices.put_settings(index=self.index, body={"index": self.original_settings})
+                if self.refresh:
+                    self.es.indices.refresh(index=self.index)
+            finally:
+                self.pool.shutdown()
+
+
+class ChecksumFile:
+    """a binary file that keeps a sha256 and a count of the bytes written to it"""
+
+    def __init__(self, path, buffer_size):
+        self.path = path
+        self.file = open(path, 'wb', buffering=buffer_size)
+        self.sha256 = hashlib.sha256()
+        self.bytes = 0
+
+    def write(self, data):
+        self.sha256.update(data)
+        self.bytes += len(data)
+        return self.file.write(data)
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
 
 
 class FSWriter(BaseWriter):
+    """writes newline delimited json files to a directory
+
+    documents are given as json bytes or strings, and each batch is written with a single write. files are named
+    {file_prefix}-00000.json, {file_prefix}-00001.json, etc., continuing after files already in the directory, and are
+    rotated once they reach max_file_bytes or max_file_docs. without limits, each batch gets its own file.
+
+    :param params: a dict with
+        directory: the output directory
+        compression: gzip or zstd (needs the zstandard package) to compress files as they are written
+        max_file_bytes, max_file_docs: rotate files at this size on disk or number of documents
+        file_prefix (part): the start of file names
+        manifest (false): write {file_prefix}-manifest.json with the documents, bytes and sha256 of each file
+        buffer_size (1MB): size of the write buffer
+    """
+    extensions = {None: '', 'gzip': '.gz', 'zstd': '.zst'}
+    accepts_bytes = True
+
     def __init__(self, params):
         super().__init__(params)
         self.type = 'filesystem'
         self.out_dir = params.get('directory')
+        self.compression = params.get('compression')
+        self.max_file_bytes = params.get('max_file_bytes')
+        self.max_file_docs = params.get('max_file_docs')
+        self.file_prefix = params.get('file_prefix', 'part')
+        self.manifest = params.get('manifest', False)
+        self.buffer_size = params.get('buffer_size', 1024 * 1024)
+
+        if self.compression not in self.extensions:
+            raise WriterError("compression must be one of gzip/zstd. please check config.")
+        if self.compression == 'zstd' and zstandard is None:
+            raise WriterError("zstd compression requires the zstandard package")
+
+        self.dir_path = os.path.join(os.path.abspath(os.getcwd()), self.out_dir)
+        os.makedirs(self.dir_path, exist_ok=True)
+        self.sequence = None
+        self.current = None
+        self.files = []
+
+    def for_shard(self, shard_id):
+        writer = copy.copy(self)
+        writer.file_prefix = "{}-s{:03d}".format(self.file_prefix, shard_id)
+        writer.sequence = None
+        writer.current = None
+        writer.files = []
+        return writer
+
+    def _open(self, file_name):
+        path = os.path.join(self.dir_path, "{}.json{}".format(file_name, self.extensions[self.compression]))
+        raw = ChecksumFile(path, self.buffer_size)
+        if self.compression == 'gzip':
+            stream = gzip.GzipFile(fileobj=raw, mode='wb')
+        elif self.compression == 'zstd':
+            stream = zstandard.ZstdCompressor().stream_writer(raw, closefd=False)
+        else:
+            stream = raw
+        return {"raw": raw, "stream": stream, "docs": 0}
+
+    def _close(self, output):
+        if output['stream'] is not output['raw']:
+            output['stream'].close()
+        output['raw'].close()
+        self.files.append({
+            "file": os.path.basename(output['raw'].path),
+            "docs": output['docs'],
+            "bytes": output['raw'].bytes,
+            "sha256": output['raw'].sha256.hexdigest()
+        })
+
+    def _numbered_files(self):
+        """return {sequence number: file name} of the files in the directory named like this writer's files"""
+        pattern = re.compile(r"{}-(\d+)\.".format(re.escape(self.file_prefix)))
+        names = os.listdir(self.dir_path) if os.path.isdir(self.dir_path) else []
+        return {int(m.group(1)): m.string for m in map(pattern.match, names) if m}
+
+    def _next_file_name(self):
+        if self.sequence is None:
+            # continue after the files of earlier runs in the same directory
+            self.sequence = max(self._numbered_files(), default=-1) + 1
+        file_name = "{}-{:05d}".format(self.file_prefix, self.sequence)
+        self.sequence += 1
+        return file_name
+
+    def checkpoint(self):
+        if self.sequence is None:
+            self.sequence = max(self._numbered_files(), default=-1) + 1
+        return {"sequence": self.sequence, "files": list(self.files)}
+
+    def restore(self, state):
+        self.sequence = state['sequence']
+        self.files = list(state['files'])
+        for sequence, name in sorted(self._numbered_files().items()):
+            if sequence >= self.sequence:
+                logging.info("removing {}, written after the last checkpoint...".format(name))
+                os.remove(os.path.join(self.dir_path, name))
+
+    def write_data(self, data, file_name=None):
+        if not data:
+            return
+        lines = encode_lines(data)
+        if self.metrics:
+            self.metrics.count('bytes_written', len(lines))
+
+        if file_name:
+            output = self._open(file_name)
+            output['stream'].write(lines)
+            output['docs'] = len(data)
+            self._close(output)
+            return
+
+        if not self.current:
+            self.current = self._open(self._next_file_name())
+        self.current['stream'].write(lines)
+        self.current['docs'] += len(data)
+
+        full = not (self.max_file_bytes or self.max_file_docs)
+        if self.max_file_bytes and self.current['raw'].bytes >= self.max_file_bytes:
+            full = True
+        if self.max_file_docs and self.current['docs'] >= self.max_file_docs:
+            full = True
+        if full:
+            self._close(self.current)
+            self.current = None
+
+    def flush(self):
+        if self.current:
+            self._close(self.current)
+            self.current = None
+        if self.manifest and self.files:
+            with open(os.path.join(self.dir_path, "{}-manifest.json".format(self.file_prefix)), 'w') as f:
+                json.dump({"files": self.files}, f, indent=2)
+
+    def close(self):
+        self.flush()
+
+
+class ParquetWriter(FSWriter):
+    """writes documents to parquet files in a directory
+
+    documents are given as flat dicts and buffered into row groups of row_group_size rows, which are converted to
+    arrow tables column by column and written with dictionary encoding. a column whose values arrow can't convert to
+    one type, like a mix of strings and numbers, is written as json strings. when a row group adds columns or changes
+    their types, a new file is started, since all row groups of a file share one schema.
+
+    :param params: a dict with
+        directory, file_prefix (part), manifest (false): as for FSWriter. files are named {file_prefix}-00000.parquet
+        compression (snappy): the parquet compression codec, e.g. snappy, zstd, gzip or none
+        row_group_size (100000): number of documents per row group
+        max_file_rows: start a new file once the current one has this many documents
+    """
+    accepts_dicts = True
+
+    def __init__(self, params):
+        if pyarrow is None:
+            raise WriterError("parquet output requires the pyarrow package")
+        super().__init__(dict(params, compression=None))
+        self.type = 'parquet'
+        self.compression = params.get('compression', 'snappy')
+        self.row_group_size = params.get('row_group_size', 100000)
+        self.max_file_rows = params.get('max_file_rows')
+        self.rows = []
+
+    def for_shard(self, shard_id):
+        writer = super().for_shard(shard_id)
+        writer.rows = []
+        return writer
+
+    def _table(self, rows):
+        columns = {}
+        for row in rows:
+            for key in row:
+                columns.setdefault(key, None)
+        arrays = []
+        for key in columns:
+            values = [row.get(key) for row in rows]
+            try:
+                arrays.append(pyarrow.array(values))
+            except (pyarrow.ArrowInvalid, pyarrow.ArrowTypeError):
+                arrays.append(pyarrow.array([None if v is None else json.dumps(v) for v in values], pyarrow.string()))
+        return pyarrow.Table.from_arrays(arrays, names=list(columns))
+
+    def _conform(self, table, schema):
+        """return table with the columns and types of schema, or None if it doesn't fit"""
+        if not set(table.column_names) <= set(schema.names):
+            return None
+        arrays = []
+        for field in schema:
+            if field.name in table.column_names:
+                try:
+                    arrays.append(table.column(field.name).cast(field.type))
+                except (pyarrow.ArrowInvalid, pyarrow.ArrowNotImplementedError):
+                    return None
+            else:
+                arrays.append(pyarrow.nulls(len(table), field.type))
+        return pyarrow.Table.from_arrays(arrays, schema=schema)
+
+    def _open(self, file_name, schema=None):
+        path = os.path.join(self.dir_path, "{}.parquet".format(file_name))
+        writer = pyarrow.parquet.ParquetWriter(path, schema, compression=self.compression, use_dictionary=True)
+        return {"path": path, "writer": writer, "schema": schema, "docs": 0}
+
+    def _close(self, output):
+        output['writer'].close()
+        sha256 = hashlib.sha256()
+        with open(output['path'], 'rb') as f:
+            for block in iter(lambda: f.read(self.buffer_size), b''):
+                sha256.update(block)
+        self.files.append({
+            "file": os.path.basename(output['path']),
+            "docs": output['docs'],
+            "bytes": os.path.getsize(output['path']),
+            "sha256": sha256.hexdigest()
+        })
+        if self.metrics:
+            self.metrics.count('bytes_written', self.files[-1]['bytes'])
+
+    def _write_rows(self, rows):
+        table = self._table(rows)
+        if self.current:
+            conformed = self._conform(table, self.current['schema'])
+            if conformed is None:
+                logging.info("schema of {} changed, starting a new file...".format(self.current['path']))
+                self._close(self.current)
+                self.current = None
+            else:
+                table = conformed
+        if not self.current:
+            self.current = self._open(self._next_file_name(), table.schema)
+        self.current['writer'].write_table(table, row_group_size=self.row_group_size)
+        self.current['docs'] += len(rows)
+        if self.max_file_rows and self.current['docs'] >= self.max_file_rows:
+            self._close(self.current)
+            self.current = None
 
     def write_data(self, data, file_name=None):
-        if not file_name:
-            file_name = str(uuid.uuid4())
-        dir_path = os.path.join(os.path.abspath(os.getcwd()), self.out_dir)
-        os.makedirs(dir_path, exist_ok=True)
-        with open("{}/{}.json".format(dir_path, file_name), 'w') as f:
-            for d in data:
-                f.write('{}\n'.format(d))
+        if not data:
+            return
+        if file_name:
+            table = self._table(data)
+            output = self._open(file_name, table.schema)
+            output['writer'].write_table(table, row_group_size=self.row_group_size)
+            output['docs'] = len(data)
+            self._close(output)
+            return
+
+        self.rows.extend(data)
+        while len(self.rows) >= self.row_group_size:
+            rows, self.rows = self.rows[:self.row_group_size], self.rows[self.row_group_size:]
+            self._write_rows(rows)
+
+    def flush(self):
+        if self.rows:
+            self._write_rows(self.rows)
+            self.rows = []
+        super().flush()
 
 
 class GCSWriter(BaseWriter):
+    """writes newline delimited json objects to a gcs bucket
+
+    batches are streamed into resumable uploads on background threads, so uploads overlap with anonymization. the
+    parts of an object are uploaded one at a time, in order, so more than one upload thread only helps while several
+    objects are open, like an object being finished while the next one is started. objects are named
+    {dir_pattern}{file_prefix}-00000.json, {dir_pattern}{file_prefix}-00001.json, etc., and a new object is started
+    once max_object_bytes of documents have been written to the current one.
+
+    :param params: a dict with
+        bucket: the destination bucket
+        credentials: the path of a service account key file
+        dir_pattern: the start of object names, e.g. a directory like anonymized/
+        endpoint, project: an api endpoint used without authentication instead of gcs, e.g. a storage emulator
+        compression: gzip to compress objects as they are uploaded
+        max_object_bytes (1GB): size of the documents written to one object, before compression
+        file_prefix (a random id): the start of object names after dir_pattern
+        upload_threads (4): number of threads uploading parts of open objects
+        chunk_size (8MB): size of each upload request, a multiple of 256KB
+        retry_timeout (300): seconds a failing upload request is retried for
+    """
+    extensions = {None: '', 'gzip': '.gz'}
+    accepts_bytes = True
+
     def __init__(self, params):
         super().__init__(params)
         self.type = 'gcs'
-        self.bucket = params.get('bucket')
+        self.bucket_name = params.get('bucket')
         self.credentials = params.get('credentials')
-        self.out_dir = params.get('dir_pattern')
+        self.out_dir = params.get('dir_pattern', '')
+        self.endpoint = params.get('endpoint')
+        self.project = params.get('project')
+        self.compression = params.get('compression')
+        self.max_object_bytes = params.get('max_object_bytes', 1024 ** 3)
+        self.file_prefix = params.get('file_prefix', str(uuid.uuid4()))
+        self.upload_threads = params.get('upload_threads', 4)
+        self.chunk_size = params.get('chunk_size', 8 * 1024 * 1024)
+        self.retry_timeout = params.get('retry_timeout', 300)
+
+        if self.compression not in self.extensions:
+            raise WriterError("compression must be gzip. please check config.")
+        if self.chunk_size % (256 * 1024):
+            raise WriterError("chunk_size must be a multiple of 256KB. please check config.")
+
+        if self.credentials:
+            os.environ['GOOGLE_APPLICATION_CREDENTIALS'] = self.credentials
+        self.sequence = 0
+        self._connect()
 
-        os.environ['GOOGLE_APPLICATION_CREDENTIALS'] = self.credentials
-        self.client = storage.Client()
-        self.bucket = self.client.get_bucket(self.bucket)
+    def _connect(self):
+        if self.endpoint:
+            self.client = storage.Client(project=self.project, client_options={"api_endpoint": self.endpoint},
+                                         use_auth_w_custom_endpoint=False)
+        else:
+            self.client = storage.Client()
+        self.bucket = self.client.get_bucket(self.bucket_name)
+        self.pool = ThreadPoolExecutor(max_workers=self.upload_threads)
+        self.pending = collections.deque()
+        self.current = None
+
+    def __getstate__(self):
+        # storage clients can't be shared with worker processes, so each worker opens its own
+        state = self.__dict__.copy()
+        for attr in ('client', 'bucket', 'pool', 'pending', 'current'):
+            state[attr] = None
+        return state
+
+    def reconnect(self):
+        # forked workers inherit the storage client and its authorized session, which they must not share
+        self._connect()
+
+    def for_shard(self, shard_id):
+        writer = copy.copy(self)
+        writer.file_prefix = "{}-s{:03d}".format(self.file_prefix, shard_id)
+        writer.sequence = 0
+        writer.current = None
+        return writer
+
+    def _open(self, name):
+        blob = self.bucket.blob(name + self.extensions[self.compression])
+        raw = blob.open('wb', chunk_size=self.chunk_size, ignore_flush=True, content_type='application/x-ndjson',
+                        retry=retry.DEFAULT_RETRY.with_timeout(self.retry_timeout))
+        stream = gzip.GzipFile(fileobj=raw, mode='wb') if self.compression == 'gzip' else raw
+        return {"raw": raw, "stream": stream, "bytes": 0, "last": None}
+
+    def _upload(self, output, lines, previous, finish):
+        # the parts of an object have to be uploaded in order
+        if previous:
+            previous.result()
+        if lines:
+            output['stream'].write(lines)
+        if finish:
+            if output['stream'] is not output['raw']:
+                output['stream'].close()
+            output['raw'].close()
+
+    def _submit(self, output, lines, finish=False):
+        # wait for the oldest upload when too many are queued, so the writer applies backpressure
+        while len(self.pending) >= 2 * self.upload_threads:
+            self.pending.popleft().result()
+        output['last'] = self.pool.submit(self._upload, output, lines, output['last'], finish)
+        self.pending.append(output['last'])
 
     def write_data(self, data, file_name=None):
-        if not file_name:
-            file_name = str(uuid.uuid4())
-        blob = self.bucket.blob('{}{}'.format(self.out_dir, file_name))
-        blob.upload_from_string("\n".join(data))
+        if not data:
+            return
+        lines = encode_lines(data)
+        if self.metrics:
+            self.metrics.count('bytes_written', len(lines))
+
+        if file_name:
+            self._submit(self._open('{}{}'.format(self.out_dir, file_name)), lines, finish=True)
+            return
+
+        if not self.current:
+            self.current = self._open('{}{}-{:05d}.json'.format(self.out_dir, self.file_prefix, self.sequence))
+            self.sequence += 1
+        self.current['bytes'] += len(lines)
+        full = self.current['bytes'] >= self.max_object_bytes
+        self._submit(self.current, lines, finish=full)
+        if full:
+            self.current = None
+
+    def flush(self):
+        if self.current:
+            self._submit(self.current, None, finish=True)
+            self.current = None
+        while self.pending:
+            self.pending.popleft().result()
+
+    def checkpoint(self):
+        return {"file_prefix": self.file_prefix, "sequence": self.sequence}
+
+    def restore(self, state):
+        self.file_prefix = state['file_prefix']
+        self.sequence = state['sequence']
+        prefix = '{}{}-'.format(self.out_dir, self.file_prefix)
+        for blob in self.client.list_blobs(self.bucket, prefix=prefix):
+            match = re.match(r"(\d+)\.json", blob.name[len(prefix):])
+            if match and int(match.group(1)) >= self.sequence:
+                logging.info("removing {}, written after the last checkpoint...".format(blob.name))
+                blob.delete()
 
+    def close(self):
+        self.flush()
+        self.pool.shutdown()
 
 
 writer_mapping = {
     "elasticsearch": ESWriter,
     "filesystem": FSWriter,
+    "parquet": ParquetWriter,
     "gcs": GCSWriter
 }
@@ -0,0 +1,195 @@
+"""end to end benchmark of Anonymizer.anonymize
+
+feeds synthetic documents shaped like the windows process events in test_configs through Anonymizer.anonymize, with
+an in-memory reader in place of ESReader and a writer that only counts what it is given, so that only anonymization
+is measured. each case runs in its own process, so that its peak RSS isn't raised by earlier cases.
+
+modes:
+    faker: the include fields of the config are masked with faker field maps (host.ip with ipv4, the others with
+        file_path, since those are the providers anonymize-it has)
+    hash: the include fields are hashed
+    sensitive: the include fields are hashed, and the sensitive fields of the config are checked for keywords, secrets
+        and user names
+
+for every mode, number of documents and cardinality of the masked fields, the documents per second, peak RSS of the
+main process and of the largest worker process, and the time of each stage, from the anonymizer's metrics, are
+printed and written to a json file, by default anonymize_benchmark_results.json, so results can be compared between
+commits.
+
+usage: python -m gen_tests.anonymize_benchmark [--docs 10000,100000] [--cardinality 100,10000]
+    [--modes faker,hash,sensitive] [--workers 1] [--output anonymize_benchmark_results.json]
+"""
+from anonymize_it.anonymizers import Anonymizer
+from anonymize_it.readers import BaseReader
+from anonymize_it.writers import BaseWriter
+from anonymize_it import utils
+from elasticsearch_dsl.response import Hit
+from gen_tests.transform_benchmark import read_config, synthetic_event
+import argparse
+import datetime
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import time
+
+MODES = ("faker", "hash", "sensitive")
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def event(i, cardinality):
+    """a synthetic event whose masked fields take cardinality distinct values"""
+    doc = synthetic_event(i)
+    value = i % cardinality
+    doc['host']['hostname'] = "WIN-HOST-{}".format(value)
+    doc['host']['ip'] = ["10.{}.{}.{}".format(value >> 16 & 255, value >> 8 & 255, value & 255), "fe80::1"]
+    doc['labels']['endpoint_id'] = "ep-{}".format(value)
+    doc['observer']['name'] = "observer-{}".format(value)
+    doc['user']['name'] = "user{}".format(value)
+    return doc
+
+
+class MemoryReader(BaseReader):
+    """an in-memory stand-in for ESReader"""
+
+    def __init__(self, docs, masked_fields):
+        super().__init__({}, masked_fields, [])
+        self.docs = docs
+        self.es = None
+
+    def create_mappings(self):
+        mappings = {field: {} for field in self.masked_fields}
+        for doc in self.docs:
+            doc = utils.flatten_nest(doc)
+            for field in self.masked_fields:
+                values = doc.get(field)
+                for value in values if type(values) == list else [values]:
+                    if value is not None:
+                        mappings[field][value] = None
+        return mappings
+
+    def get_count(self):
+        return len(self.docs)
+
+    def get_data(self, include_all=False, slice_id=None, max_slices=None):
+        docs = self.docs
+        if max_slices and max_slices > 1:
+            docs = docs[slice_id::max_slices]
+        for doc in docs:
+            yield Hit({"_index": "benchmark", "_source": doc})
+
+    def infer_providers(self):
+        pass
+
+
+class CountingWriter(BaseWriter):
+    """a writer that discards documents and only counts them"""
+
+    def __init__(self, params):
+        super().__init__(params)
+        self.docs = 0
+
+    def write_data(self, data, file_name=None):
+        self.docs += len(data)
+
+
+def run_case(mode, num_docs, cardinality, workers):
+    config = read_config()
+    if mode == "faker":
+        masked_fields = {field: "ipv4" if field == "host.ip" else "file_path" for field in config['include']}
+    else:
+        masked_fields = dict(config['include'])
+    docs = [event(i, cardinality) for i in range(num_docs)]
+
+    anon = Anonymizer(reader=MemoryReader(docs, masked_fields), writer=CountingWriter({}))
+    anon.hashkey = "benchmark"
+    sensitive_fields = []
+    if mode == "sensitive":
+        sensitive_fields = config['sensitive']
+        anon.keywords = ["customer-{}".format(i) for i in range(20)]
+        anon.user_regexes = {"users": r"(C:\\Users\\)[^\\]+"}
+
+    start = time.perf_counter()
+    anon.anonymize(sensitive_fields=sensitive_fields, include_rest=config['include_rest'],
+                   anonymization_type="hash" if mode == "sensitive" else mode, workers=workers)
+    seconds = time.perf_counter() - start
+
+    stages = {stage: anon.metrics.histogram("{}_seconds".format(stage)) for stage in ("read", "anonymize", "write")}
+    stages = {stage: histogram.sum if histogram else 0.0 for stage, histogram in stages.items()}
+    # the time not spent on batches, mostly creating faker field maps. with workers, stage times are summed over the
+    # workers, so they add up to more than the run took
+    stages['setup'] = seconds - sum(stages.values()) if workers == 1 else None
+    return {
+        "mode": mode,
+        "docs": num_docs,
+        "cardinality": cardinality,
+        "workers": workers,
+        "seconds": seconds,
+        "docs_per_second": num_docs / seconds,
+        # ru_maxrss is in kilobytes on linux. with workers, documents are anonymized in the worker processes, whose
+        # peak is that of the largest worker, once the pool has ended
+        "main_peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "worker_peak_rss_mb": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024 if workers > 1 else None,
+        "stage_seconds": stages,
+        "documents_written": anon.metrics.get('documents_written'),
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True,
+                              cwd=ROOT).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def main(args):
+    results = []
+    print("{:<10}{:>10}{:>13}{:>12}{:>10}{:>10}{:>13}{:>9}{:>9}".format(
+        "mode", "docs", "cardinality", "docs / s", "rss MB", "setup s", "anonymize s", "read s", "write s"))
+    for mode in args.modes.split(","):
+        for num_docs in map(int, args.docs.split(",")):
+            for cardinality in map(int, args.cardinality.split(",")):
+                # a fresh process per case, so that peak RSS is the case's own
+                out = subprocess.run([sys.executable, "-m", "gen_tests.anonymize_benchmark", "--case", mode,
+                                      str(num_docs), str(cardinality), str(args.workers)],
+                                     capture_output=True, text=True, check=True, cwd=ROOT)
+                result = json.loads(out.stdout.strip().splitlines()[-1])
+                results.append(result)
+                stages = result['stage_seconds']
+                setup = "-" if stages['setup'] is None else "{:.2f}".format(stages['setup'])
+                # the larger of the main process and the largest worker
+                rss = max(result['main_peak_rss_mb'], result['worker_peak_rss_mb'] or 0)
+                print("{:<10}{:>10}{:>13}{:>12.0f}{:>10.1f}{:>10}{:>13.2f}{:>9.2f}{:>9.2f}".format(
+                    mode, num_docs, cardinality, result['docs_per_second'], rss, setup,
+                    stages['anonymize'], stages['read'], stages['write']))
+
+    with open(args.output, 'w') as f:
+        json.dump({
+            "date": datetime.datetime.now(datetime.timezone.utc).isoformat(timespec='seconds'),
+            "commit": git_commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "results": results,
+        }, f, indent=2)
+    print("results written to {}".format(args.output))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="end to end benchmark of Anonymizer.anonymize")
+    parser.add_argument("--docs", default="10000,100000", help="comma separated numbers of documents")
+    parser.add_argument("--cardinality", default="100,10000",
+                        help="comma separated numbers of distinct values of the masked fields")
+    parser.add_argument("--modes", default=",".join(MODES))
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--output", default="anonymize_benchmark_results.json")
+    parser.add_argument("--case", nargs=4, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.case:
+        mode, num_docs, cardinality, workers = args.case
+        print(json.dumps(run_case(mode, int(num_docs), int(cardinality), int(workers))))
+    else:
+        main(args)
@@ -1,8 +1,21 @@
+"""collision rates of faker providers, and of deterministic field maps
+
+results are appended to collision_results.csv, or deterministic_collision_results.csv, in the current directory.
+
+usage: python -m gen_tests.collision_testing <seed> [deterministic]
+"""
 from faker import Faker
+from anonymize_it.mappings import DeterministicFieldMap
 import sys
 import os
 
 
+def write_header(results_file):
+    if not os.path.exists(results_file):
+        with open(results_file, 'w') as f:
+            f.write("seed, provider, total, unique, pct_unique\n")
+
+
 def main(seed):
     f = Faker()
     f.seed(seed)
@@ -10,9 +23,7 @@ def main(seed):
     providers = [f.file_path, f.ipv4, f.phone_number, f.credit_card_number]
     # generate fake files
 
-    if not os.path.exists("collision_results.csv"):
-        with open("collision_results.csv", 'w') as f:
-            f.write("seed, provider, total, unique, pct_unique\n")
+    write_header("collision_results.csv")
 
     with open("collision_results.csv", "a") as f:
         for provider in providers:
@@ -31,6 +42,36 @@ def main(seed):
                 )
 
 
+def main_deterministic(seed):
+    """collision rates of deterministic field maps, where the seed is used as the hashkey
+
+    every original value is distinct, so any repeated fake value is a collision
+    """
+    f = Faker()
+    num = [10, 100, 1000, 10000, 100000, 1000000]
+    providers = [f.file_path, f.ipv4, f.phone_number, f.credit_card_number]
+
+    write_header("deterministic_collision_results.csv")
+
+    with open("deterministic_collision_results.csv", "a") as out:
+        for provider in providers:
+            print("working on: {}".format(provider.__name__))
+            field_map = DeterministicFieldMap(f, provider, seed, cache_size=0)
+            for n in num:
+                fakes = set(field_map.get("original-{}".format(i)) for i in range(n))
+
+                out.write("{},{},{},{},{: .4f}\n".format(
+                    seed,
+                    provider.__name__,
+                    n,
+                    len(fakes),
+                    100*(len(fakes)/n))
+                )
+
+
 if __name__ == "__main__":
     seed = sys.argv[1]
-    main(seed)
+    if len(sys.argv) > 2 and sys.argv[2] == "deterministic":
+        main_deterministic(seed)
+    else:
+        main(seed)
@@ -0,0 +1,45 @@
+"""microbenchmark of hash-based anonymization of values
+
+compares utils.hash_value, which hashes every value, with utils.Hasher, which caches the hashes of recent values, on
+values that repeat like user and host names do.
+
+usage: python -m gen_tests.hash_benchmark [num_values] [num_distinct]
+"""
+from anonymize_it import utils
+import random
+import sys
+import timeit
+
+
+def main(num_values, num_distinct):
+    rng = random.Random(1234)
+    # a skewed distribution, where a few values make up most of the data
+    distinct = ["user-{}".format(i) for i in range(num_distinct)]
+    values = rng.choices(distinct, weights=[1 / (i + 1) for i in range(num_distinct)], k=num_values)
+
+    hashkey = "benchmark"
+    assert utils.Hasher(hashkey).hash_many(values[:1000]) == [utils.hash_value(hashkey, v) for v in values[:1000]]
+
+    def one_by_one(**options):
+        # a new hasher for every run, so that runs start with an empty cache
+        def run():
+            hasher = utils.Hasher(hashkey, **options)
+            return [hasher(v) for v in values]
+        return run
+
+    runs = [
+        ("hash_value", lambda: [utils.hash_value(hashkey, v) for v in values]),
+        ("uncached", one_by_one(cache_size=0)),
+        ("lru", one_by_one()),
+        ("lru+batch", lambda: utils.Hasher(hashkey).hash_many(values)),
+    ]
+    print("{:<18}{:>12}".format("engine", "ns / value"))
+    for name, run in runs:
+        seconds = min(timeit.repeat(run, number=1, repeat=5))
+        print("{:<18}{:>12.0f}".format(name, seconds / num_values * 1e9))
+
+
+if __name__ == "__main__":
+    num_values = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    num_distinct = int(sys.argv[2]) if len(sys.argv) > 2 else 10000
+    main(num_values, num_distinct)
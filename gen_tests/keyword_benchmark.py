@@ -0,0 +1,39 @@
+"""benchmark of keyword matching for document dropping
+
+compares utils.contains_keywords, which checks every keyword against every value, with the single pass
+patterns.KeywordIndex, for drop lists of different sizes.
+
+usage: python -m gen_tests.keyword_benchmark [num_values]
+"""
+from anonymize_it import utils
+from anonymize_it.patterns import KeywordIndex
+from faker import Faker
+import sys
+import timeit
+
+
+def main(num_values):
+    f = Faker()
+    f.seed_instance(0)
+    values = [
+        "C:\\Windows\\System32\\cmd.exe /c copy \\\\{}\\share\\{} {}".format(f.hostname(), f.file_name(), f.file_path())
+        for _ in range(num_values)
+    ]
+
+    print("{:>10}{:>16}{:>16}{:>16}".format("keywords", "current us/val", "index us/val", "build s"))
+    for num_keywords in (10, 1000, 100000):
+        keywords = list({"{}-{}".format(f.company().split()[0].lower(), i) for i in range(num_keywords)})
+        start = timeit.default_timer()
+        index = KeywordIndex(keywords)
+        build = timeit.default_timer() - start
+
+        assert all(bool(utils.contains_keywords(v, keywords)) == index.search(v) for v in values[:20])
+        current = min(timeit.repeat(lambda: [utils.contains_keywords(v, keywords) for v in values], number=1, repeat=3))
+        indexed = min(timeit.repeat(lambda: [index.search(v) for v in values], number=1, repeat=3))
+        print("{:>10}{:>16.2f}{:>16.2f}{:>16.3f}".format(
+            num_keywords, current / num_values * 1e6, indexed / num_values * 1e6, build))
+
+
+if __name__ == "__main__":
+    num_values = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    main(num_values)
@@ -0,0 +1,132 @@
+"""microbenchmark of the per-document anonymization cost
+
+compares the per-field branching loop that anonymize() used to run for every document with the compiled plan used now,
+on a synthetic document shaped like the windows process events in test_configs.
+
+usage: python -m gen_tests.transform_benchmark [num_docs]
+"""
+from anonymize_it.anonymizers import Anonymizer
+from anonymize_it import utils, patterns
+import json
+import os
+import re
+import sys
+import timeit
+
+config_path = os.path.join(os.path.dirname(__file__), "..", "test_configs", "windows_process_events", "config.json")
+
+
+def read_config():
+    with open(config_path, 'r') as f:
+        # the test configs start with a comment line
+        return json.loads(f.read().split("\n", 1)[1])
+
+
+def synthetic_event(i):
+    return {
+        "@timestamp": "2020-12-09T01:30:{:02d}.000Z".format(i % 60),
+        "event": {"kind": "event", "category": "process", "type": "start", "action": "creation", "id": str(i)},
+        "host": {
+            "hostname": "WIN-HOST-{}".format(i % 50),
+            "ip": ["10.0.{}.{}".format(i % 7, i % 250), "fe80::1"],
+            "os": {"name": "Windows", "version": "10.0", "family": "windows"},
+        },
+        "labels": {"account_id": "acct-{}".format(i % 3), "endpoint_id": "ep-{}".format(i % 50)},
+        "observer": {"name": "observer-{}".format(i % 5)},
+        "user": {"domain": "CORP", "name": "user{}".format(i % 200)},
+        "process": {
+            "pid": i,
+            "name": "powershell.exe",
+            "executable": "C:\\Windows\\System32\\WindowsPowerShell\\v1.0\\powershell.exe",
+            "args": ["powershell.exe", "-NoProfile", "-Command", "Get-ChildItem C:\\Users\\user{}".format(i % 200)],
+            "pe": {"original_file_name": "PowerShell.EXE"},
+            "parent": {
+                "pid": i + 1,
+                "name": "explorer.exe",
+                "executable": "C:\\Windows\\explorer.exe",
+                "args": ["C:\\Windows\\explorer.exe"],
+            },
+        },
+        "endgame": {
+            "command_line": "powershell.exe -NoProfile -Command Get-ChildItem C:\\Users\\user{}".format(i % 200),
+            "parent": {"command_line": "C:\\Windows\\explorer.exe"},
+            "event_type_full": "process_event",
+        },
+        "ecs": {"version": "1.5.0"},
+        "agent": {"type": "endgame", "version": "3.0"},
+    }
+
+
+class StandInReader:
+    def __init__(self, masked_fields):
+        self.masked_fields = masked_fields
+
+
+def legacy_transform(anon, item, sensitive_fields, anonymization_type, all_secrets_regex):
+    """the per-field loop anonymize() ran for every document before plans and pattern registries were compiled"""
+    contains_keywords = False
+    for field in list(item):
+        if anonymization_type == "faker":
+            if anon.high_cardinality_fields.get(field):
+                item[field] = anon.high_cardinality_fields[field][len(item[field]) % len(anon.high_cardinality_fields[field])]
+            elif anon.field_maps.get(field, None):
+                if type(item[field]) == list:
+                    item[field] = [anon.field_maps[field].get(f, "This should not happen (list)!!!") for f in item[field]]
+                else:
+                    item[field] = anon.field_maps[field].get(item[field], "This should not happen!!!")
+        else:
+            if field in anon.reader.masked_fields:
+                if type(item[field]) == list:
+                    item[field] = [utils.hash_value(anon.hashkey, f) for f in item[field]]
+                else:
+                    item[field] = utils.hash_value(anon.hashkey, item[field])
+        if field in sensitive_fields:
+            if utils.contains_keywords(item[field], anon.keywords):
+                contains_keywords = True
+                break
+            if utils.contains_secret(all_secrets_regex, item[field]):
+                del item[field]
+                continue
+            if anon.user_regexes:
+                all_users_regex = re.compile('|'.join([regex for regex in anon.user_regexes.values()]), flags=re.MULTILINE|re.IGNORECASE)
+                if type(item[field]) == list:
+                    item[field] = [re.sub(all_users_regex, r"\1", f) for f in item[field]]
+                else:
+                    item[field] = re.sub(all_users_regex, r"\1", item[field])
+    if not contains_keywords:
+        return item
+
+
+def main(num_docs):
+    config = read_config()
+    sensitive_fields = config['sensitive']
+
+    anon = Anonymizer(reader=StandInReader(config['include']), writer=object())
+    anon.hashkey = "benchmark"
+    anon.keywords = ["customer-{}".format(i) for i in range(20)]
+    anon.user_regexes = {"users": r"(C:\\Users\\)[^\\]+"}
+    anon.patterns = patterns.get_registry(anon.secret_regexes, anon.user_regexes, anon.keywords)
+    all_secrets_regex = re.compile('|'.join([regex for regex in anon.secret_regexes.values()]))
+    plan = anon.compile_plan(sensitive_fields, "hash")
+
+    docs = [utils.flatten_nest(synthetic_event(i)) for i in range(num_docs)]
+    assert all(legacy_transform(anon, dict(doc), sensitive_fields, "hash", all_secrets_regex) == anon.anonymize_document(dict(doc), plan)
+               for doc in docs[:100])
+
+    def run_legacy():
+        for doc in docs:
+            legacy_transform(anon, dict(doc), sensitive_fields, "hash", all_secrets_regex)
+
+    def run_plan():
+        for doc in docs:
+            anon.anonymize_document(dict(doc), plan)
+
+    print("{:<10}{:>16}".format("mode", "us / document"))
+    for name, run in (("legacy", run_legacy), ("plan", run_plan)):
+        seconds = min(timeit.repeat(run, number=1, repeat=5))
+        print("{:<10}{:>16.2f}".format(name, seconds / num_docs * 1e6))
+
+
+if __name__ == "__main__":
+    num_docs = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    main(num_docs)
@@ -0,0 +1,57 @@
+"""size and throughput of the output writers
+
+writes the same synthetic, flattened windows process events with FSWriter (plain, gzip and zstd) and with
+ParquetWriter (snappy and zstd), and reports the time per document, including json serialization for FSWriter, and the
+size on disk.
+
+usage: python -m gen_tests.writer_benchmark [num_docs]
+"""
+from anonymize_it import writers, utils
+from gen_tests.transform_benchmark import synthetic_event
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+batch_size = 10000
+
+configs = [
+    ("json", writers.FSWriter, {}),
+    ("json gzip", writers.FSWriter, {"compression": "gzip"}),
+    ("json zstd", writers.FSWriter, {"compression": "zstd"}),
+    ("parquet snappy", writers.ParquetWriter, {"compression": "snappy"}),
+    ("parquet zstd", writers.ParquetWriter, {"compression": "zstd"}),
+]
+
+
+def run(writer_class, params, docs):
+    out_dir = tempfile.mkdtemp()
+    try:
+        writer = writer_class(dict(params, directory=out_dir, max_file_docs=len(docs)))
+        start = time.perf_counter()
+        writer.open()
+        for i in range(0, len(docs), batch_size):
+            batch = docs[i:i + batch_size]
+            writer.write_data(batch if writer.accepts_dicts else [json.dumps(doc) for doc in batch])
+        writer.close()
+        seconds = time.perf_counter() - start
+        size = sum(os.path.getsize(os.path.join(out_dir, name)) for name in os.listdir(out_dir))
+        return seconds, size
+    finally:
+        shutil.rmtree(out_dir)
+
+
+def main(num_docs):
+    docs = [utils.flatten_nest(synthetic_event(i)) for i in range(num_docs)]
+
+    print("{:<16}{:>16}{:>12}{:>16}".format("writer", "us / document", "MB", "bytes / doc"))
+    for name, writer_class, params in configs:
+        seconds, size = min(run(writer_class, params, docs) for _ in range(3))
+        print("{:<16}{:>16.2f}{:>12.2f}{:>16.1f}".format(name, seconds / num_docs * 1e6, size / 1e6, size / num_docs))
+
+
+if __name__ == "__main__":
+    num_docs = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    main(num_docs)
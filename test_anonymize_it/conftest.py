@@ -0,0 +1,46 @@
+from elasticsearch_dsl.response import Hit
+from anonymize_it import readers, utils
+import pytest
+
+
+class ListReader(readers.BaseReader):
+    """an in-memory reader over a list of documents, used in place of ESReader"""
+
+    def __init__(self, docs, masked_fields, suppressed_fields=None):
+        super().__init__({}, masked_fields, suppressed_fields or [])
+        self.docs = docs
+        self.es = None
+
+    def create_mappings(self):
+        mappings = {field: {} for field in self.masked_fields}
+        for doc in self.docs:
+            doc = utils.flatten_nest(doc)
+            for field, provider in self.masked_fields.items():
+                if provider and field in doc:
+                    mappings[field][doc[field]] = None
+        return mappings
+
+    def get_count(self):
+        return len(self.docs)
+
+    def get_data(self, include_all=False, slice_id=None, max_slices=None):
+        docs = self.docs
+        if max_slices and max_slices > 1:
+            docs = docs[slice_id::max_slices]
+        for doc in docs:
+            yield Hit({"_index": "test-index", "_source": doc})
+
+    def infer_providers(self):
+        pass
+
+
+@pytest.fixture
+def docs():
+    """documents with an event.id and one of 7 source.ip values"""
+    return [{"event": {"id": i}, "source": {"ip": "10.0.0.{}".format(i % 7)}} for i in range(50)]
+
+
+@pytest.fixture
+def reader(docs):
+    """a ListReader of docs, with source.ip masked as ipv4"""
+    return ListReader(docs, {"source.ip": "ipv4", "event.id": None})
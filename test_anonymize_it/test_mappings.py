@@ -0,0 +1,90 @@
+from anonymize_it import mappings
+from faker import Faker
+import gc
+import itertools
+import pickle
+
+
+def test_lazy_field_map():
+    counter = itertools.count()
+    field_map = mappings.LazyFieldMap(lambda: "fake-{}".format(next(counter)))
+
+    assert field_map
+    assert field_map.get("a") == "fake-0"
+    assert field_map.get("b") == "fake-1"
+    assert field_map.get("a") == "fake-0"
+    assert field_map.get(["unhashable"], "default") == "default"
+    assert len(field_map) == 2
+
+
+def test_lazy_field_map_max_size():
+    counter = itertools.count()
+    field_map = mappings.LazyFieldMap(lambda: next(counter), max_size=2)
+
+    assert [field_map.get(v) for v in ("a", "b", "a", "c")] == [0, 1, 0, 2]
+    # b was the least recently used value
+    assert "b" not in field_map
+    assert field_map.get("a") == 0
+    assert field_map.evicted == 1
+
+
+def test_mapping_store(tmp_path):
+    path = str(tmp_path / "mappings.sqlite")
+    counter = itertools.count()
+    store = mappings.MappingStore(path)
+    field_map = store.field_map("source.ip", lambda: "fake-{}".format(next(counter)))
+    assert [field_map.get(v) for v in ("a", "b", "a")] == ["fake-0", "fake-1", "fake-0"]
+    store.close()
+
+    # a later run reuses stored values and only generates new ones
+    store = mappings.MappingStore(path)
+    field_map = store.field_map("source.ip", lambda: "fake-{}".format(next(counter)))
+    assert [field_map.get(v) for v in ("b", "c")] == ["fake-1", "fake-2"]
+    assert store.insert("source.ip", "c", "other") == "fake-2"
+    assert store.count("source.ip") == 3
+    assert store.count("destination.ip") == 0
+
+    # filling adds the new values of a whole map at once
+    assert store.fill("source.ip", ["a", "d", 1, (1, 2)], lambda: "fake-{}".format(next(counter))) == \
+        {"a": "fake-0", "d": "fake-3", 1: "fake-4"}
+    assert store.count("source.ip") == 5
+    assert not store.conn.in_transaction
+
+
+def test_deterministic_field_map():
+    f = Faker()
+    field_map = mappings.DeterministicFieldMap(f, f.ipv4, "key")
+    fakes = [field_map.get(v) for v in ("10.0.0.1", "10.0.0.2", "10.0.0.1")]
+    assert fakes[0] == fakes[2] != fakes[1]
+
+    # another process or run with the same key gets the same values, and a different key gets different ones
+    other = Faker()
+    assert mappings.DeterministicFieldMap(other, other.ipv4, "key", cache_size=0).get("10.0.0.1") == fakes[0]
+    assert mappings.DeterministicFieldMap(other, other.ipv4, "other key").get("10.0.0.1") != fakes[0]
+    assert pickle.loads(pickle.dumps(field_map)).get("10.0.0.2") == fakes[1]
+
+
+def test_compact_field_map(tmp_path):
+    values = {"10.0.0.{}".format(i): "192.168.0.{}".format(i % 3) for i in range(100)}
+    values.update({"host-{}".format(i): "fake-{}".format(i) for i in range(100)})
+    values.update({"01.2.3.4": "not an ip", "\ud800": "surrogate", 7: "int", True: None})
+    field_map = mappings.CompactFieldMap(values.items(), cache_size=8)
+
+    assert len(field_map) == len(values)
+    for _ in range(2):
+        assert all(field_map.get(value) == fake for value, fake in values.items())
+    assert field_map.get("10.0.1.0", "missing") == "missing"
+    assert field_map.get(["unhashable"], "missing") == "missing"
+    assert field_map.get(8, "missing") == "missing"
+    # an address with a fake value that isn't a string
+    assert mappings.CompactFieldMap([("10.0.0.1", 5), ("host", "x")]).get("10.0.0.1", "MISSING") == 5
+
+    size = field_map.nbytes
+    field_map.spill(str(tmp_path))
+    assert len(list(tmp_path.iterdir())) == 1
+    assert field_map.nbytes == size
+    for restored in (field_map, pickle.loads(pickle.dumps(field_map))):
+        assert all(restored.get(value) == fake for value, fake in values.items())
+    del field_map, restored
+    gc.collect()
+    assert list(tmp_path.iterdir()) == []
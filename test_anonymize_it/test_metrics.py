@@ -0,0 +1,43 @@
+from anonymize_it import metrics
+import pickle
+import pstats
+
+
+def test_histogram():
+    histogram = metrics.Histogram()
+    for seconds in [0.0005, 0.001, 0.003, 0.003, 10]:
+        histogram.observe(seconds)
+
+    assert histogram.count == 5
+    assert histogram.counts[0] == 2
+    assert histogram.quantile(0.5) == 0.004
+    assert histogram.quantile(1) == 16.384
+
+
+def test_metrics_merge_and_dump():
+    run = metrics.Metrics(callback=lambda m: None)
+    run.count('documents_read', 10)
+    worker = pickle.loads(pickle.dumps(run))
+    worker.count('documents_read', 5)
+    worker.count('transform_calls', 2, field='user.name')
+    worker.observe('write_seconds', 0.02)
+    run.merge(worker)
+
+    assert run.get('documents_read') == 25
+    assert run.summary()['counters']['transform_calls{field=user.name}'] == 2
+    prometheus = run.to_prometheus()
+    assert 'anonymize_it_documents_read_total 25' in prometheus
+    assert 'anonymize_it_transform_calls_total{field="user.name"} 2' in prometheus
+    assert 'anonymize_it_write_seconds_bucket{le="0.032"} 1' in prometheus
+    assert 'anonymize_it_write_seconds_count 1' in prometheus
+
+
+def test_profile(tmp_path):
+    with metrics.profile(str(tmp_path / "run.prof")):
+        sum(range(1000))
+    assert pstats.Stats(str(tmp_path / "run.prof")).total_calls > 0
+
+    with metrics.profile(str(tmp_path / "run.stacks"), profiler='sampling', interval=0.001):
+        sum(i * i for i in range(1000000))
+    with open(tmp_path / "run.stacks") as f:
+        assert "test_metrics:test_profile" in f.read()
@@ -0,0 +1,32 @@
+from anonymize_it import pipeline
+import pytest
+
+
+def test_pipeline():
+    written = []
+    stages = pipeline.Pipeline(read_queue=1, write_queue=1, batch_size=7)
+    count = stages.run(range(100), lambda batch: [i * 2 for i in batch if i % 3], written.append)
+
+    assert [i for batch in written for i in batch] == [i * 2 for i in range(100) if i % 3]
+    assert count == len([i for i in range(100) if i % 3])
+    assert stages.stats['read'].items == 100
+    assert stages.stats['read'].batches == stages.stats['write'].batches == 15
+
+
+def test_pipeline_writer_error():
+    def write(batch):
+        raise IOError("disk full")
+
+    with pytest.raises(IOError):
+        pipeline.Pipeline(batch_size=10).run(range(1000), list, write)
+
+
+def test_pipeline_reader_error():
+    def data():
+        yield from range(25)
+        raise ValueError("scroll expired")
+
+    written = []
+    with pytest.raises(ValueError):
+        pipeline.Pipeline(batch_size=10).run(data(), list, written.append)
+    assert len(written) == 2
@@ -1,4 +1,207 @@
-from anonymize_it import readers
+from anonymize_it import metrics, readers
+import gzip
+import json
+import pandas
+import zstandard
 
 def test_esreader():
-    pass
\ No newline at end of file
+    pass
+
+
+class FakePitClient:
+    def __init__(self, docs):
+        self.docs = docs
+        self.closed = []
+
+    def open_point_in_time(self, index, keep_alive):
+        return {"id": "pit-1"}
+
+    def search(self, body, **params):
+        start = body["search_after"][0] + 1 if "search_after" in body else 0
+        hits = [{"_index": "test", "_source": doc, "sort": [start + i]}
+                for i, doc in enumerate(self.docs[start:start + body["size"]])]
+        return {"pit_id": "pit-2", "hits": {"hits": hits}}
+
+    def close_point_in_time(self, body):
+        self.closed.append(body["id"])
+
+
+def test_pit_scan():
+    es = FakePitClient([{"n": i} for i in range(25)])
+    hits = list(readers.pit_scan(es, "test", {"query": {"match_all": {}}}, size=10))
+
+    assert [hit.to_dict() for hit in hits] == es.docs
+    assert hits[-1].meta.sort == [24]
+    assert es.closed == ["pit-2"]
+
+
+class FakeScrollClient:
+    def __init__(self, docs):
+        self.docs = docs
+        self.cleared = []
+
+    def _page(self, start, size):
+        hits = [{"_index": "test", "_source": doc} for doc in self.docs[start:start + size]]
+        # like filter_path, leave out the hits of an empty page
+        response = {"_scroll_id": str(start + size)}
+        if hits:
+            response["hits"] = {"hits": hits}
+        return response
+
+    def search(self, index, body, scroll, size, filter_path):
+        assert body["sort"] == ["_doc"]
+        self.size = size
+        return self._page(0, size)
+
+    def scroll(self, body, filter_path):
+        return self._page(int(body["scroll_id"]), self.size)
+
+    def clear_scroll(self, body, ignore):
+        self.cleared.extend(body["scroll_id"])
+
+
+def test_raw_scans():
+    docs = [{"n": i} for i in range(25)]
+    es = FakeScrollClient(docs)
+    assert [hit["_source"] for hit in readers.raw_scroll(es, "test", {}, size=10)] == docs
+    assert es.cleared == ["40"]
+
+    hits = list(readers.pit_scan(FakePitClient(docs), "test", {}, size=10, search_after=[19], raw=True))
+    assert hits == [{"_index": "test", "_source": {"n": i}, "sort": [i]} for i in range(20, 25)]
+
+
+def test_fast_json_serializer():
+    serializer = readers.FastJSONSerializer()
+    assert serializer.loads('{"hits": {"hits": [{"_source": {"n": 1}}]}}') == {"hits": {"hits": [{"_source": {"n": 1}}]}}
+    # orjson rejects lone surrogates, which json accepts
+    assert serializer.loads('{"s": "\\ud800"}') == {"s": "\ud800"}
+
+
+class FakeAggregationClient:
+    def __init__(self, values):
+        self.values = values
+        self.requests = 0
+
+    def search(self, index, body):
+        self.requests += 1
+        body = json.loads(body)
+        aggregations = {}
+        for name, agg in body["aggs"].items():
+            field = agg["composite"]["sources"][0].popitem()[0]
+            start = agg["composite"].get("after", {}).get(field, -1) + 1
+            keys = self.values[field][start:start + agg["composite"]["size"]]
+            aggregations[name] = {"buckets": [{"key": {field: k}} for k in keys]}
+            if keys:
+                aggregations[name]["after_key"] = {field: keys[-1]}
+        return {"aggregations": aggregations}
+
+
+def test_create_mappings():
+    reader = readers.ESReader.__new__(readers.ESReader)
+    reader.masked_fields = {"a": "ipv4", "b": "ipv4", "c": None}
+    reader.index_pattern = "test"
+    reader.query = None
+    reader.mapping_threads = 2
+    reader.fields_per_request = 2
+    reader.es = FakeAggregationClient({"a": list(range(25000)), "b": list(range(3))})
+    reader.metrics = metrics.Metrics()
+
+    mappings = reader.create_mappings()
+
+    assert list(mappings["a"]) == list(range(25000))
+    assert list(mappings["b"]) == list(range(3))
+    assert mappings["c"] == {}
+    assert reader.es.requests == 3
+    # b only took part in the first of the two requests for a
+    assert reader.metrics.histogram('mapping_seconds', field='b').sum < reader.metrics.histogram('mapping_seconds',
+                                                                                                field='a').sum
+
+
+def test_csvreader(tmp_path):
+    for part in range(2):
+        with open(tmp_path / "part-{}.csv".format(part), 'w') as f:
+            f.write("host.name,source.ip,secret\n")
+            for i in range(5):
+                f.write("host-{},{},s\n".format(i, "10.0.0.{}".format(i % 3) if i else ""))
+
+    reader = readers.CSVReader({"path": str(tmp_path), "chunk_size": 2}, {"source.ip": "ipv4", "host.name": None},
+                               ["secret"])
+
+    assert reader.get_count() == 10
+    assert reader.create_mappings() == {"source.ip": {"10.0.0.1": None, "10.0.0.2": None, "10.0.0.0": None},
+                                        "host.name": {}}
+    docs = [hit.to_dict() for hit in reader.get_data(include_all=True)]
+    assert docs[:2] == [{"host.name": "host-0"}, {"host.name": "host-1", "source.ip": "10.0.0.1"}]
+    assert len(docs) == 10
+    # chunks are dealt to slices in turn
+    assert [len(frame) for frame in reader.get_frames(slice_id=1, max_slices=2)] == [2, 2, 1]
+
+
+def test_pandasreader_counts_rows_once(tmp_path, monkeypatch):
+    pandas.DataFrame({"source.ip": ["10.0.0.{}".format(i % 3) for i in range(7)]}).to_parquet(tmp_path / "in.parquet")
+    reads = []
+    read_parquet = pandas.read_parquet
+
+    def counting_read_parquet(path, **kwargs):
+        reads.append(path)
+        return read_parquet(path, **kwargs)
+
+    monkeypatch.setattr(pandas, "read_parquet", counting_read_parquet)
+    reader = readers.PandasReader({"path": str(tmp_path / "in.parquet"), "chunk_size": 3}, {"source.ip": "ipv4"}, [])
+
+    assert len(reader.create_mappings()["source.ip"]) == 3
+    assert reader.get_count() == 7
+    assert len(reads) == 1
+
+
+def test_ndjsonreader(tmp_path):
+    docs = [{"source": {"ip": "10.0.0.{}".format(i % 5)}, "event": {"id": i}, "secret": "s"} for i in range(30)]
+    with open(tmp_path / "hits.json", 'w') as f:
+        for doc in docs[:10]:
+            f.write(json.dumps({"_index": "test", "_id": str(doc["event"]["id"]), "_source": doc}) + "\n")
+    with gzip.open(tmp_path / "bulk.ndjson.gz", 'wt') as f:
+        for doc in docs[10:20]:
+            f.write(json.dumps({"index": {"_index": "test"}}) + "\n" + json.dumps(doc) + "\n")
+    with open(tmp_path / "docs.jsonl.zst", 'wb') as f:
+        f.write(zstandard.ZstdCompressor().compress("\n".join(json.dumps(doc) for doc in docs[20:]).encode()))
+
+    reader = readers.NDJSONReader({"path": str(tmp_path)}, {"source.ip": "ipv4", "event.id": None}, ["secret"])
+
+    assert reader.get_count() == 30
+    assert reader.create_mappings() == {"source.ip": {"10.0.0.{}".format(i): None for i in range(5)}, "event.id": {}}
+    hits = list(reader.get_data(include_all=True))
+    assert hits[-1]["_id"] == "9"
+    assert sorted((hit["_source"] for hit in hits), key=lambda d: d["event.id"]) == \
+        [{"source.ip": doc["source"]["ip"], "event.id": doc["event"]["id"]} for doc in docs]
+
+    # byte ranges of uncompressed files and whole compressed files are split between slices
+    for max_slices in (2, 3, 7):
+        ids = [hit["_source"]["event.id"] for slice_id in range(max_slices)
+               for hit in reader.get_data(slice_id=slice_id, max_slices=max_slices)]
+        assert sorted(ids) == list(range(30))
+
+
+def test_ndjsonreader_bulk_detection(tmp_path):
+    # documents that look like bulk actions are kept in plain files
+    docs = [{"index": {"name": "x{}".format(i)}} for i in range(4)]
+    with open(tmp_path / "plain.json", 'w') as f:
+        f.write("".join(json.dumps(doc) + "\n" for doc in docs))
+    reader = readers.NDJSONReader({"path": str(tmp_path / "plain.json")}, {}, [])
+    assert [hit["_source"] for hit in reader.hits()] == docs
+    assert reader.get_count() == 4
+
+    # bulk files alternate actions and documents, and deletes have no document
+    lines = [{"index": {"_index": "test", "_id": "1"}}, docs[0], {"delete": {"_id": "2"}},
+             {"create": {"_id": "3"}}, {"index": {"name": "y"}}, {"update": {"_id": "4"}}, {"doc": docs[1]}]
+    with open(tmp_path / "bulk.json", 'w') as f:
+        f.write("".join(json.dumps(line) + "\n" for line in lines))
+    reader = readers.NDJSONReader({"path": str(tmp_path / "bulk.json")}, {}, [])
+    assert list(reader.hits()) == [{"_index": "test", "_id": "1", "_source": docs[0]},
+                                   {"_id": "3", "_source": {"index": {"name": "y"}}},
+                                   {"_id": "4", "_source": docs[1]}]
+
+    # a plain file whose first document looks just like an action is read as plain with bulk set to false
+    with open(tmp_path / "ambiguous.json", 'w') as f:
+        f.write("".join(json.dumps(doc) + "\n" for doc in [{"index": {"_id": "1"}}] + docs))
+    reader = readers.NDJSONReader({"path": str(tmp_path / "ambiguous.json"), "bulk": False}, {}, [])
+    assert len(list(reader.hits(slice_id=0, max_slices=2))) + len(list(reader.hits(slice_id=1, max_slices=2))) == 5
@@ -0,0 +1,31 @@
+from anonymize_it import serializers, writers
+import json
+import os
+import pytest
+
+
+def test_serializers_agree():
+    doc = {"user.name": "Ünïcode", "event.id": 1, "big": 2 ** 70, "process.args": ["a", None], "score": 1.5}
+    for name in ("json", "orjson", "auto"):
+        serializer = serializers.get_serializer(name)
+        assert json.loads(serializer.dumps(doc)) == doc
+        assert json.loads(serializer.dumps_text(doc)) == doc
+
+    with pytest.raises(serializers.SerializerError):
+        serializers.get_serializer("yaml")
+
+
+def test_non_finite_floats():
+    doc = {"score": float("nan"), "max": float("inf")}
+    assert serializers.get_serializer().dumps_text(doc) == '{"score": NaN, "max": Infinity}'
+    assert serializers.get_serializer("orjson").dumps_text(doc) == '{"score":null,"max":null}'
+
+
+def test_fswriter_bytes(tmp_path):
+    writer = writers.FSWriter({"directory": str(tmp_path)})
+    writer.write_data([b'{"n": 1}', b'{"n": 2}'])
+    writer.write_data(['{"n": 3}'])
+    writer.close()
+
+    lines = [json.loads(line) for name in sorted(os.listdir(tmp_path)) for line in open(tmp_path / name)]
+    assert lines == [{"n": 1}, {"n": 2}, {"n": 3}]
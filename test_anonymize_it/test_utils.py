@@ -1,3 +1,7 @@
+import pytest
+import json
+import os
+import pickle
 from anonymize_it import utils
 
 
@@ -15,3 +19,99 @@ def test_flatten_nest():
     flattened = utils.flatten_nest(old)
     new = {"this.is.a.test": True}
     assert new == flattened
+
+
+def test_merge_threaded():
+    merged = list(utils.merge_threaded([range(0, 100), range(100, 150), []], max_queued=5))
+    assert sorted(merged) == list(range(150))
+
+
+def test_merge_threaded_raises():
+    def failing():
+        yield 1
+        raise ValueError("slice failed")
+
+    with pytest.raises(ValueError):
+        list(utils.merge_threaded([failing(), range(10)]))
+
+
+def test_hasher_matches_hash_value():
+    values = ["bob", "bob", "Ünïcode", 1, 1.0, True, None, "", ["a", "b"]]
+    hasher = utils.Hasher("key", cache_size=4)
+    assert [hasher(value) for value in values] == [utils.hash_value("key", value) for value in values]
+    assert hasher.hash_many(values[:-1]) == [utils.hash_value("key", value) for value in values[:-1]]
+
+    hasher = pickle.loads(pickle.dumps(hasher))
+    assert hasher("bob") == utils.hash_value("key", "bob")
+
+
+def test_hasher_doesnt_cache_equal_floats():
+    values = [0.0, -0.0, 0, 1.0, 1, True]
+    hasher = utils.Hasher("key")
+    assert [hasher(value) for value in values] == [utils.hash_value("key", value) for value in values]
+    assert hasher.hash_many(values) == [utils.hash_value("key", value) for value in values]
+
+
+class FakeClusterClient:
+    def __init__(self, cluster_uuid):
+        self.cluster_uuid = cluster_uuid
+
+    def info(self):
+        return {"cluster_uuid": self.cluster_uuid}
+
+
+def test_get_hashkey_cache(tmp_path, monkeypatch):
+    lookups = []
+    monkeypatch.setattr(utils, "lookup_hashkey", lambda es: lookups.append(es.cluster_uuid) or "key-" + es.cluster_uuid)
+    monkeypatch.delenv(utils.HASHKEY_ENV, raising=False)
+    monkeypatch.delenv(utils.HASHKEY_FILE_ENV, raising=False)
+    cache_path = str(tmp_path / "cache" / "hashkeys.json")
+
+    assert utils.get_hashkey(FakeClusterClient("a"), cache_path) == "key-a"
+    assert utils.get_hashkey(FakeClusterClient("a"), cache_path) == "key-a"
+    assert utils.get_hashkey(FakeClusterClient("b"), cache_path) == "key-b"
+    assert lookups == ["a", "b"]
+    assert os.stat(cache_path).st_mode & 0o777 == 0o600
+
+    # expired keys are looked up again
+    with open(cache_path) as f:
+        cache = json.load(f)
+    cache["a"]["expires"] = 0
+    with open(cache_path, 'w') as f:
+        json.dump(cache, f)
+    assert utils.get_hashkey(FakeClusterClient("a"), cache_path) == "key-a"
+    assert utils.get_hashkey(FakeClusterClient("a"), cache_path) == "key-a"
+    assert lookups == ["a", "b", "a"]
+
+    # keys from the environment win over the cache
+    key_file = tmp_path / "hashkey"
+    key_file.write_text("file-key\n")
+    monkeypatch.setenv(utils.HASHKEY_FILE_ENV, str(key_file))
+    assert utils.get_hashkey(FakeClusterClient("a"), cache_path) == "file-key"
+    monkeypatch.setenv(utils.HASHKEY_ENV, "env-key")
+    assert utils.get_hashkey(None) == "env-key"
+
+
+def test_unflatten_nest():
+    doc = {
+        "@timestamp": "2020-12-09T01:30:00.000Z",
+        "process": {"args": ["cmd.exe", "/c"], "parent": {"pid": 1, "name": None}},
+        "dns": {"answers": [{"data": "10.0.0.1", "ttl": {"seconds": 60}}]},
+        "host": {"ip": "10.0.0.2"},
+    }
+    flat = utils.flatten_nest(doc)
+
+    assert list(flat) == ["@timestamp", "process.args", "process.parent.pid", "process.parent.name", "dns.answers",
+                          "host.ip"]
+    assert flat["dns.answers"] == [{"data": "10.0.0.1", "ttl": {"seconds": 60}}]
+    assert utils.unflatten_nest(flat) == doc
+    # keys that can't be nested under a value are kept flat
+    assert utils.unflatten_nest({"a": None, "a.b": 1, "c.d": 2}) == {"a": None, "a.b": 1, "c": {"d": 2}}
+
+
+def test_unflatten_nest_conflicts():
+    # a key nested under another key's value is kept flat, whichever key comes first
+    assert utils.unflatten_nest({"a.b": 1, "a": 2}) == {"a": 2, "a.b": 1}
+    assert utils.unflatten_nest({"a": 2, "a.b": 1}) == {"a": 2, "a.b": 1}
+    assert utils.unflatten_nest({"x.a.b.c": 1, "x.a.b": 2, "x.d": 3}) == {"x": {"a": {"b": 2, "b.c": 1}, "d": 3}}
+    assert utils.unflatten_nest({"x.a.b": 2, "x.d": 3, "x.a.b.c": 1}) == {"x": {"a": {"b": 2, "b.c": 1}, "d": 3}}
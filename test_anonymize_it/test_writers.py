@@ -1,6 +1,16 @@
-from anonymize_it import writers
+from anonymize_it import metrics, writers
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import base64
+import google_crc32c
+import gzip
+import hashlib
 import json
 import os
+import pyarrow.parquet
+import pytest
+import threading
+import zstandard
+from urllib.parse import parse_qs, urlparse
 
 
 def test_fswriter():
@@ -26,5 +36,263 @@ def test_fswriter():
     assert data == in_data
 
 
+def test_fswriter_rotation(tmp_path):
+    params = {
+        "directory": str(tmp_path),
+        "compression": "gzip",
+        "max_file_docs": 25,
+        "manifest": True
+    }
+    data = [json.dumps({"n": i}) for i in range(60)]
+
+    fswriter = writers.FSWriter(params)
+    for i in range(0, 60, 10):
+        fswriter.write_data(data[i:i + 10])
+    fswriter.close()
+
+    with open(tmp_path / "part-manifest.json") as f:
+        manifest = json.load(f)["files"]
+    # files are rotated after the batch that reaches max_file_docs
+    assert [entry["file"] for entry in manifest] == ["part-00000.json.gz", "part-00001.json.gz"]
+    assert [entry["docs"] for entry in manifest] == [30, 30]
+
+    written = []
+    for entry in manifest:
+        with open(tmp_path / entry["file"], 'rb') as f:
+            raw = f.read()
+        assert entry["bytes"] == len(raw)
+        assert entry["sha256"] == hashlib.sha256(raw).hexdigest()
+        written.extend(gzip.decompress(raw).decode().splitlines())
+    assert written == data
+
+    # a second run continues the numbering
+    fswriter = writers.FSWriter(dict(params, compression="zstd", manifest=False))
+    shard = fswriter.for_shard(3)
+    shard.write_data(data[:5])
+    shard.flush()
+    with open(tmp_path / "part-s003-00000.json.zst", 'rb') as f:
+        assert zstandard.ZstdDecompressor().decompressobj().decompress(f.read()).decode().splitlines() == data[:5]
+    fswriter.write_data(data[:5])
+    fswriter.close()
+    assert os.path.exists(tmp_path / "part-00002.json.zst")
+
+
+def test_parquetwriter(tmp_path):
+    parquetwriter = writers.ParquetWriter({"directory": str(tmp_path), "row_group_size": 4, "manifest": True})
+    rows = [{"host.name": "host-{}".format(i % 2), "event.id": i} for i in range(6)]
+    # a new column starts a new file, and a column with mixed types is written as json strings
+    mixed = [{"host.name": "host-0", "event.id": 6, "labels": [1, "a"]}]
+    # a changed type starts a new file
+    retyped = [{"host.name": "host-1", "event.id": "seven"}]
+    parquetwriter.write_data(rows)
+    parquetwriter.write_data(mixed)
+    parquetwriter.flush()
+    parquetwriter.write_data(retyped)
+    parquetwriter.close()
+
+    with open(tmp_path / "part-manifest.json") as f:
+        manifest = json.load(f)["files"]
+    assert [entry["file"] for entry in manifest] == ["part-00000.parquet", "part-00001.parquet", "part-00002.parquet"]
+    assert [entry["docs"] for entry in manifest] == [4, 3, 1]
+
+    first = pyarrow.parquet.ParquetFile(tmp_path / "part-00000.parquet")
+    assert "RLE_DICTIONARY" in first.metadata.row_group(0).column(0).encodings
+    second = pyarrow.parquet.read_table(tmp_path / "part-00001.parquet").to_pylist()
+    assert second == [
+        {"host.name": "host-0", "event.id": 4, "labels": None},
+        {"host.name": "host-1", "event.id": 5, "labels": None},
+        {"host.name": "host-0", "event.id": 6, "labels": '[1, "a"]'},
+    ]
+    assert pyarrow.parquet.read_table(tmp_path / "part-00002.parquet").to_pylist() == retyped
+
+
+class MockElasticsearch(BaseHTTPRequestHandler):
+    """just enough of the elasticsearch http api for ESWriter"""
+    docs = []
+    settings = []
+    requests = []
+    rejected = False
+
+    def log_message(self, *args):
+        pass
+
+    def respond(self, status, body=None):
+        payload = json.dumps(body or {}).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("X-Elastic-Product", "Elasticsearch")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(payload)
+
+    def body(self):
+        return self.rfile.read(int(self.headers.get("Content-Length", 0))).decode()
+
+    def do_GET(self):
+        self.respond(200, {"version": {"number": "7.17.0", "build_flavor": "default"}, "tagline": "You Know, for Search"})
+
+    def do_HEAD(self):
+        self.respond(404)
+
+    def do_PUT(self):
+        self.requests.append(("PUT", self.path))
+        self.settings.append(json.loads(self.body()))
+        self.respond(200, {"acknowledged": True})
+
+    def do_POST(self):
+        self.requests.append(("POST", self.path))
+        if not self.path.startswith("/test-index/_bulk"):
+            return self.respond(200)
+        lines = self.body().splitlines()
+        docs = [json.loads(line) for line in lines[1::2]]
+        if not MockElasticsearch.rejected:
+            # reject the first bulk request, so the writer has to retry
+            MockElasticsearch.rejected = True
+            items = [{"index": {"status": 429, "error": {"type": "es_rejected_execution_exception"}}} for _ in docs]
+        else:
+            self.docs.extend(docs)
+            items = [{"index": {"status": 201}} for _ in docs]
+        self.respond(200, {"took": 1, "errors": not MockElasticsearch.rejected, "items": items})
+
+
 def test_ESWriter():
-    pass
+    server = ThreadingHTTPServer(("127.0.0.1", 0), MockElasticsearch)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        eswriter = writers.ESWriter({
+            "host": "http://127.0.0.1:{}".format(server.server_port),
+            "index": "test-index",
+            "chunk_size": 10,
+            "bulk_threads": 2,
+            "initial_backoff": 0,
+            "optimize_settings": True,
+        })
+        eswriter.metrics = metrics.Metrics()
+        data = [json.dumps({"n": i, "user": "Jürgen"}, ensure_ascii=False) for i in range(95)]
+        eswriter.open()
+        eswriter.write_data(data[:50])
+        eswriter.write_data(data[50:])
+        eswriter.close()
+    finally:
+        server.shutdown()
+
+    assert sorted(doc["n"] for doc in MockElasticsearch.docs) == list(range(95))
+    assert eswriter.metrics.get('bytes_written') == sum(len(doc.encode()) for doc in data)
+    assert MockElasticsearch.settings[0] == {"settings": {"index": {"refresh_interval": "-1", "number_of_replicas": 0}}}
+    assert MockElasticsearch.settings[-1] == {"index": {"refresh_interval": None, "number_of_replicas": None}}
+    assert ("POST", "/test-index/_refresh") in MockElasticsearch.requests
+
+
+class RejectingElasticsearch(MockElasticsearch):
+    """a MockElasticsearch that rejects every document for good"""
+    docs = []
+    settings = []
+    requests = []
+
+    def do_POST(self):
+        if not self.path.startswith("/test-index/_bulk"):
+            return super().do_POST()
+        self.requests.append(("POST", self.path))
+        docs = self.body().splitlines()[1::2]
+        items = [{"index": {"status": 400, "error": {"type": "mapper_parsing_exception"}}} for _ in docs]
+        self.respond(200, {"took": 1, "errors": True, "items": items})
+
+
+def test_ESWriter_restores_settings_on_failure():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), RejectingElasticsearch)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        eswriter = writers.ESWriter({
+            "host": "http://127.0.0.1:{}".format(server.server_port),
+            "index": "test-index",
+            "initial_backoff": 0,
+            "optimize_settings": True,
+        })
+        eswriter.open()
+        eswriter.write_data([json.dumps({"n": i}) for i in range(5)])
+        with pytest.raises(writers.WriterError):
+            eswriter.close()
+    finally:
+        server.shutdown()
+
+    assert RejectingElasticsearch.settings[-1] == {"index": {"refresh_interval": None, "number_of_replicas": None}}
+    assert ("POST", "/test-index/_refresh") in RejectingElasticsearch.requests
+    assert eswriter.pool._shutdown
+
+
+class MockGCS(BaseHTTPRequestHandler):
+    """just enough of the gcs json and resumable upload apis for GCSWriter"""
+    objects = {}
+    uploads = {}
+
+    def log_message(self, *args):
+        pass
+
+    def respond(self, status, body=None, headers=None):
+        payload = json.dumps(body or {}).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def body(self):
+        return self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+    def do_GET(self):
+        self.respond(200, {"name": self.path.split("?")[0].split("/")[-1]})
+
+    def do_POST(self):
+        # start a resumable upload
+        name = json.loads(self.body())["name"]
+        upload_id = str(len(self.uploads))
+        self.uploads[upload_id] = (name, bytearray())
+        location = "http://{}:{}/upload/storage/v1/b/test-bucket/o?uploadType=resumable&upload_id={}".format(
+            *self.server.server_address, upload_id)
+        self.respond(200, headers={"Location": location})
+
+    def do_PUT(self):
+        name, data = self.uploads[parse_qs(urlparse(self.path).query)["upload_id"][0]]
+        data.extend(self.body())
+        if self.headers["Content-Range"].endswith("/*"):
+            return self.respond(308, headers={"Range": "bytes=0-{}".format(len(data) - 1)})
+        self.objects[name] = bytes(data)
+        crc32c = base64.b64encode(google_crc32c.Checksum(self.objects[name]).digest()).decode()
+        self.respond(200, {"name": name, "bucket": "test-bucket", "size": str(len(data)), "crc32c": crc32c})
+
+
+def test_GCSWriter():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), MockGCS)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        gcswriter = writers.GCSWriter({
+            "bucket": "test-bucket",
+            "endpoint": "http://127.0.0.1:{}".format(server.server_port),
+            "project": "test",
+            "dir_pattern": "anonymized/",
+            "file_prefix": "run",
+            "compression": "gzip",
+            "max_object_bytes": 1024 * 1024,
+            "chunk_size": 256 * 1024,
+            "upload_threads": 2,
+            "retry_timeout": 5,
+        })
+        client = gcswriter.client
+        gcswriter.reconnect()
+        assert gcswriter.client is not client
+        # random hex doesn't compress well, so each object takes more than one upload request
+        data = [json.dumps({"n": i, "payload": os.urandom(150).hex()}) for i in range(6000)]
+        for i in range(0, 6000, 500):
+            gcswriter.write_data(data[i:i + 500])
+        gcswriter.close()
+    finally:
+        server.shutdown()
+
+    assert sorted(MockGCS.objects) == ["anonymized/run-00000.json.gz", "anonymized/run-00001.json.gz"]
+    written = []
+    for name in sorted(MockGCS.objects):
+        written.extend(gzip.decompress(MockGCS.objects[name]).decode().splitlines())
+    assert written == data